@@ -0,0 +1,606 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Бенчмарк масштабирования: генерирует уровни заданного размера в формате levels/*.json
+# и измеряет время загрузки, пиковую память процесса (RSS), скорость симуляции (шагов в секунду)
+# и отрисовки (кадров в секунду) с видеодрайвером SDL "dummy".
+# Времена - медиана по --repeat замерам. Результаты пишутся в JSON и могут сравниваться
+# с сохраненным базовым запуском (регрессия - замедление больше --tolerance и --floor).
+#
+#   python benchmark.py --sizes 100 10000 1000000 -o results.json
+#   python benchmark.py -o new.json --baseline results.json
+#   python benchmark.py --blits   (скорость отрисовки спрайтов в разных форматах)
+#   python benchmark.py --collision   (столкновения с блоками: прежние два прохода и TileMap.sweep)
+#   python benchmark.py --startup --startup-target 1.5   (время холодного запуска)
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+import level_cache
+import level_stream
+import main
+
+# Размеры уровней по умолчанию (число клеток сетки)
+SIZES = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+# Высота сгенерированного уровня в клетках (как у встроенных уровней)
+ROWS = 10
+
+# Метрики: True - чем больше, тем лучше
+METRICS = {"load_seconds": False,
+           "load_compiled_seconds": False,
+           "load_streamed_seconds": False,
+           "peak_rss_bytes": False,
+           "steps_per_second": True,
+           "frames_per_second": True,
+           "pipelined_steps_per_second": True}
+
+# Меньшая разница с базовым запуском не считается регрессией (шум таймера и страниц памяти):
+# для времен и скоростей - секунды на весь замер, для памяти - байты
+TIME_FLOOR = 0.005
+MEMORY_FLOOR = 4 * 2 ** 20
+
+
+def generate_level(cols, rows=ROWS, density=0.1, enemies=0.05, coins=0.1, powerups=0.01, seed=0):
+    # Уровень cols x rows клеток в формате levels/*.json.
+    # density - доля столбцов, над которыми начинается платформа,
+    # enemies/coins/powerups - число объектов на столбец.
+    rng = random.Random(seed)
+    cols = max(cols, 4)
+    solid = set()
+    blocks = []
+
+    # Земля по всей ширине
+    for x in range(cols):
+        blocks.append([x, rows - 1, "TM"])
+        solid.add((x, rows - 1))
+
+    # Парящие платформы (строка rows - 2 остается свободной для врагов)
+    for x in range(cols):
+        if rng.random() >= density:
+            continue
+
+        y = rng.randrange(2, rows - 2)
+        length = min(rng.randint(1, 6), cols - x)
+        cells = [(cx, y) for cx in range(x, x + length) if (cx, y) not in solid]
+
+        if len(cells) != length:
+            continue
+
+        for i, (cx, cy) in enumerate(cells):
+            if length == 1:
+                code = "LF"
+            elif i == 0:
+                code = "EL"
+            elif i == length - 1:
+                code = "ER"
+            else:
+                code = "TM"
+
+            blocks.append([cx, cy, code])
+            solid.add((cx, cy))
+
+    def free_cells(count, y_range):
+        # Свободные клетки для объектов (не в блоках и не у старта)
+        cells = []
+
+        for i in range(int(count)):
+            x, y = rng.randrange(6, cols) if cols > 6 else rng.randrange(cols), rng.choice(y_range)
+
+            if (x, y) not in solid:
+                cells.append([x, y])
+
+        return cells
+
+    walkers = free_cells(enemies * cols, [rows - 2])
+    pickups = free_cells(powerups * cols, range(1, rows - 1))
+
+    return {"name": "Benchmark %dx%d" % (cols, rows),
+            "width": cols,
+            "height": rows,
+            "background-color": [130, 182, 255],
+            "background-img": "assets/backgrounds/mountains.png",
+            "background-position": "top",
+            "background-repeat-x": 1,
+            "background-fill-y": 1,
+            "scenery-img": "assets/backgrounds/forest.png",
+            "scenery-position": "bottom",
+            "scenery-repeat-x": 1,
+            "scenery-fill-y": 1,
+            "music": "",
+            "start": [2, rows - 2],
+            "gravity": 1.0,
+            "terminal-velocity": 32,
+            "blocks": blocks,
+            "bears": walkers[0::2],
+            "monsters": walkers[1::2],
+            "coins": free_cells(coins * cols, range(1, rows - 1)),
+            "oneups": pickups[0::2],
+            "hearts": pickups[1::2],
+            "flag": [[cols - 2, y] for y in range(rows - 5, rows - 1)]}
+
+
+def write_level(map_data, path):
+    with open(path, 'w') as f:
+        json.dump(map_data, f)
+
+    return path
+
+
+def script(steps):
+    # Ввод для симуляции: бег вправо с прыжком раз в 30 кадров
+    for i in range(steps):
+        if i % 30 == 0:
+            yield {main.RIGHT, main.JUMP}
+        else:
+            yield {main.RIGHT}
+
+
+def play(game, level):
+    # Запуск уровня в игре, минуя список levels
+    game.level = level
+    level.reset()
+    game.hero = main.Character(main.hero_images)
+    game.hero.respawn(level)
+    game.stage = main.Game.PLAYING
+
+    # Герой не должен закончить игру посреди замера
+    game.hero.lives = 10 ** 9
+
+
+def measure(game, path, steps, frames, repeat=1):
+    # Все метрики для одного уровня: времена - медиана по repeat замерам
+    samples = [measure_times(game, path, steps, frames) for i in range(repeat)]
+    result = {metric: sorted(s[metric] for s in samples)[repeat // 2] for metric in samples[0]}
+
+    # Память считается в отдельном процессе: пик RSS растет только вверх
+    # и после других уровней ничего не говорил бы об этом
+    result.update(measure_memory(path, steps, frames))
+
+    return result
+
+
+def measure_times(game, path, steps, frames):
+    # Один замер времен загрузки, симуляции и отрисовки
+    result = {}
+
+    # Первая загрузка - из JSON, без старого скомпилированного файла
+    if os.path.exists(level_cache.compiled_path(path)):
+        os.remove(level_cache.compiled_path(path))
+
+    started = time.perf_counter()
+    level = main.Level(path)
+    result["load_seconds"] = time.perf_counter() - started
+
+    level_cache.compile_level(path)
+    started = time.perf_counter()
+    main.Level(path)
+    result["load_compiled_seconds"] = time.perf_counter() - started
+
+    # Потоковый уровень: заголовок и чанки у старта
+    level_stream.convert(path)
+    started = time.perf_counter()
+    main.StreamingLevel(level_stream.streamed_path(path)).reset()
+    result["load_streamed_seconds"] = time.perf_counter() - started
+
+    play(game, level)
+    started = time.perf_counter()
+    done = game.simulate(script(steps))
+    result["steps_per_second"] = done / (time.perf_counter() - started)
+
+    play(game, level)
+    started = time.perf_counter()
+
+    for pressed, keys in main.ScriptedInput(script(frames)):
+        game.step(pressed, keys)
+        game.draw()
+
+    result["frames_per_second"] = frames / (time.perf_counter() - started)
+
+    # То же с отрисовкой в отдельном потоке (PIPELINED_RENDER): шаги симуляции
+    # не ждут отрисовку, кадры, которые поток отрисовки не успел показать, пропускаются
+    play(game, level)
+    pipelined, main.PIPELINED_RENDER = main.PIPELINED_RENDER, True
+    game.start_renderer()
+    started = time.perf_counter()
+
+    for pressed, keys in main.ScriptedInput(script(frames)):
+        game.step(pressed, keys)
+        game.draw()
+
+    result["pipelined_steps_per_second"] = frames / (time.perf_counter() - started)
+    game.stop_renderer()
+    main.PIPELINED_RENDER = pipelined
+
+    return result
+
+
+# Пиковая память процесса (RSS, вместе с поверхностями SDL и чанками слоев) при загрузке
+# уровня, симуляции и отрисовке; level_rss_bytes - прирост к пику после создания игры
+# (только для отчета: на маленьких уровнях это доли мегабайта и шум страниц памяти).
+# Без модуля resource (Windows) память не измеряется.
+MEMORY_SCRIPT = """
+import json, sys
+try:
+    import resource
+except ImportError:
+    print(json.dumps({}))
+    sys.exit()
+import benchmark, main
+scale = 1 if sys.platform == "darwin" else 1024
+def peak():
+    # В Linux ru_maxrss дочернего процесса включает пик родителя (до exec), VmHWM - нет
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+game = main.Game(headless=True)
+before = peak()
+level = main.Level(sys.argv[1])
+benchmark.play(game, level)
+game.simulate(benchmark.script(int(sys.argv[2])))
+for pressed, keys in main.ScriptedInput(benchmark.script(int(sys.argv[3]))):
+    game.step(pressed, keys)
+    game.draw()
+print(json.dumps({"peak_rss_bytes": peak(), "level_rss_bytes": peak() - before}))
+"""
+
+
+def measure_memory(path, steps, frames):
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    output = subprocess.run([sys.executable, "-c", MEMORY_SCRIPT, os.path.abspath(path), str(steps), str(frames)],
+                            env=env, check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(main.__file__))).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+# Спрайты для замера отрисовки
+BLIT_IMAGES = [main.coin_img, main.hero_images["idle"], main.monster_images[0], main.bear_images[0]]
+
+
+def blit_variants(path):
+    # Одно изображение в разных форматах: как загружено, convert_alpha,
+    # подповерхность атласа и convert_alpha с RLE
+    raw = pygame.transform.smoothscale(pygame.image.load(path), (main.GRID_SIZE, main.GRID_SIZE))
+    converted = raw.convert_alpha()
+    rle = raw.convert_alpha()
+    rle.set_alpha(255, pygame.RLEACCEL)
+
+    return {"raw": raw, "converted": converted, "atlas": main.Atlas().add(converted), "rle": rle}
+
+
+def measure_blits(screen, count):
+    # Отрисовок в секунду для каждого формата (спрайты разбросаны по экрану)
+    rng = random.Random(0)
+    positions = [(rng.randrange(screen.get_width()), rng.randrange(screen.get_height())) for i in range(count)]
+    variants = [blit_variants(path) for path in BLIT_IMAGES]
+    result = {}
+
+    for name in variants[0]:
+        images = [v[name] for v in variants]
+        sequence = [(images[i % len(images)], pos) for i, pos in enumerate(positions)]
+
+        started = time.perf_counter()
+        screen.blits(sequence, False)
+        result[name] = count / (time.perf_counter() - started)
+
+    return result
+
+
+# Скорости для сравнения столкновений: как у встроенных уровней (terminal-velocity)
+# и намного больше клетки, когда прежнему способу нужны подшаги
+COLLISION_SPEEDS = {"normal": 32, "fast": 4 * main.GRID_SIZE}
+
+
+def resolve_two_pass(tiles, rect, vx, vy):
+    # Прежнее разрешение столкновений: сдвиг по оси и поиск пересечений с блоками,
+    # сначала по x, потом по y. Возвращает, был ли упор по каждой оси
+    rect.x += vx
+    hit_list = tiles.collide(rect)
+
+    for block in hit_list:
+        if vx > 0:
+            rect.right = block.left
+        elif vx < 0:
+            rect.left = block.right
+
+    rect.y += vy
+    hit_y = tiles.collide(rect)
+
+    for block in hit_y:
+        if vy > 0:
+            rect.bottom = block.top
+        elif vy < 0:
+            rect.top = block.bottom
+
+    return bool(hit_list), bool(hit_y)
+
+
+def resolve_substeps(tiles, rect, vx, vy):
+    # Прежний способ с подшагами не длиннее половины клетки (чтобы не проскакивать блоки)
+    n = 2 * max(abs(vx), abs(vy)) // main.GRID_SIZE + 1
+
+    for i in range(n):
+        hit_x, hit_y = resolve_two_pass(tiles, rect, vx * (i + 1) // n - vx * i // n, vy * (i + 1) // n - vy * i // n)
+
+        if hit_x:
+            vx = 0
+
+        if hit_y:
+            vy = 0
+
+
+def measure_collision(count, seed=0):
+    # Перемещений в секунду для каждого способа и скорости на сгенерированном уровне.
+    # Прямоугольники размером с героя начинают в свободных местах; "wrong" - доля
+    # перемещений, где прежний способ без подшагов останавливается не там, где
+    # TileMap.sweep (проскочил блок или застрял в нем). С подшагами движение идет
+    # по диагонали, а не сначала по x, поэтому конечные точки с TileMap.sweep не сравниваются
+    rng = random.Random(seed)
+    tiles = main.TileMap.from_grid(level_cache.build_grid(generate_level(1000, seed=seed)))
+    size = main.GRID_SIZE
+    starts = []
+
+    while len(starts) < count:
+        rect = pygame.Rect(rng.randrange(tiles.cols * size), rng.randrange(tiles.rows * size), size, size)
+
+        if not tiles.collide(rect):
+            starts.append(rect)
+
+    result = {}
+
+    for name, speed in COLLISION_SPEEDS.items():
+        moves = [(r, rng.randint(-speed, speed), rng.randint(-speed, speed)) for r in starts]
+        variants = {"two_pass": resolve_two_pass, "sweep": main.TileMap.sweep}
+
+        if speed > size // 2:
+            variants["two_pass_substeps"] = resolve_substeps
+
+        ends = {}
+
+        for variant, move in variants.items():
+            rects = [r.copy() for r, vx, vy in moves]
+
+            started = time.perf_counter()
+
+            for rect, (r, vx, vy) in zip(rects, moves):
+                move(tiles, rect, vx, vy)
+
+            result["%s_%s" % (name, variant)] = count / (time.perf_counter() - started)
+            ends[variant] = rects
+
+        wrong = sum(a != b for a, b in zip(ends["two_pass"], ends["sweep"]))
+        result["%s_two_pass_wrong" % name] = wrong / count
+
+    return result
+
+
+# Холодный запуск в отдельном процессе: импорт main, инициализация pygame и окна,
+# первый кадр уровня (загрузка уровня, изображений и шрифтов)
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import main, pygame
+imported = time.perf_counter()
+initialized_on_import = pygame.get_init()
+game = main.Game(headless=True)
+initialized = time.perf_counter()
+game.hero = main.Character(main.hero_images)
+game.start()
+game.stage = main.Game.PLAYING
+game.draw()
+drawn = time.perf_counter()
+print(json.dumps({"import_seconds": imported - started,
+                  "init_seconds": initialized - imported,
+                  "first_frame_seconds": drawn - initialized,
+                  "total_seconds": drawn - started,
+                  "initialized_on_import": initialized_on_import}))
+"""
+
+# Метрики запуска (все - чем меньше, тем лучше)
+STARTUP_METRICS = ["import_seconds", "init_seconds", "first_frame_seconds", "total_seconds"]
+
+
+def measure_startup(runs):
+    # Медиана по runs запускам для каждой метрики
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    samples = []
+
+    for i in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env, check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(main.__file__))).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+
+    result = {metric: sorted(s[metric] for s in samples)[runs // 2] for metric in STARTUP_METRICS}
+    result["initialized_on_import"] = any(s["initialized_on_import"] for s in samples)
+
+    return result
+
+
+def run_startup(runs, target=None):
+    result = measure_startup(runs)
+
+    for metric in STARTUP_METRICS:
+        print("%-20s %8.3fs" % (metric, result[metric]))
+
+    if result["initialized_on_import"]:
+        print("WARNING: importing main initializes pygame")
+
+    if target is not None:
+        print("target %.3fs: %s" % (target, "ok" if result["total_seconds"] <= target else "EXCEEDED"))
+
+    return {"python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "startup": result}
+
+
+def run(sizes, steps, frames, levels_dir=None, seed=0, repeat=1):
+    # Бенчмарк для всех размеров, результат - словарь для JSON
+    game = main.Game(headless=True)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            cols = max(size // ROWS, 1)
+            map_data = generate_level(cols, seed=seed)
+            path = write_level(map_data, os.path.join(levels_dir or tmp, "bench-%d.json" % size))
+
+            result = {"tiles": cols * ROWS,
+                      "blocks": len(map_data["blocks"]),
+                      "enemies": len(map_data["bears"]) + len(map_data["monsters"]),
+                      "json_bytes": os.path.getsize(path)}
+            result.update(measure(game, path, steps, frames, repeat))
+            results.append(result)
+
+            print("%8d tiles: load %.3fs (compiled %.3fs, streamed %.3fs), peak RSS %.1f MB (level %.1f MB), %.0f steps/s, %.0f fps, "
+                  "%.0f steps/s with pipelined drawing" %
+                  (result["tiles"], result["load_seconds"], result["load_compiled_seconds"], result["load_streamed_seconds"],
+                   result.get("peak_rss_bytes", 0) / 2 ** 20, result.get("level_rss_bytes", 0) / 2 ** 20, result["steps_per_second"], result["frames_per_second"],
+                   result["pipelined_steps_per_second"]))
+
+    return {"python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "steps": steps,
+            "frames": frames,
+            "repeat": repeat,
+            "results": results}
+
+
+def run_blits(count):
+    main.Game(headless=True)
+    result = measure_blits(pygame.display.get_surface(), count)
+
+    for name, rate in result.items():
+        print("%-10s %10.0f blits/s" % (name, rate))
+
+    return {"python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "blits": result}
+
+
+def run_collision(count):
+    result = measure_collision(count)
+
+    for name, rate in result.items():
+        if name.endswith("_wrong"):
+            print("%-32s %9.1f%%" % (name, 100 * rate))
+        else:
+            print("%-32s %10.0f moves/s" % (name, rate))
+
+    return {"python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "collision": result}
+
+
+def cost(report, metric, value):
+    # Значение метрики в единицах порога: скорость - время всего замера в секундах
+    if not METRICS[metric]:
+        return value
+
+    return (report["steps"] if metric == "steps_per_second" else report["frames"]) / value
+
+
+def compare(report, baseline, tolerance, floor=TIME_FLOOR):
+    # Сравнение с базовым запуском; возвращает список регрессий. Регрессия - замедление
+    # больше tolerance и больше floor секунд (для памяти - больше MEMORY_FLOOR байт)
+    old = {r["tiles"]: r for r in baseline["results"]}
+    regressions = []
+
+    for result in report["results"]:
+        base = old.get(result["tiles"])
+
+        if base is None:
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            if not base.get(metric) or not result.get(metric):
+                continue
+
+            change = result[metric] / base[metric] - 1
+
+            if not higher_is_better:
+                change = -change
+
+            difference = cost(report, metric, result[metric]) - cost(baseline, metric, base[metric])
+            flag = ""
+
+            if change < -tolerance and difference > (MEMORY_FLOOR if metric.endswith("_bytes") else floor):
+                flag = "  REGRESSION"
+                regressions.append((result["tiles"], metric, change))
+
+            print("%8d tiles %-22s %12.4g -> %12.4g  %+6.1f%%%s" %
+                  (result["tiles"], metric, base[metric], result[metric], 100 * change, flag))
+
+    return regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark level loading, simulation and drawing on generated levels.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="level sizes in tiles")
+    parser.add_argument("--steps", type=int, default=600, help="simulation steps per level")
+    parser.add_argument("--frames", type=int, default=120, help="drawn frames per level")
+    parser.add_argument("--seed", type=int, default=0, help="level generator seed")
+    parser.add_argument("--levels-dir", help="keep generated levels in this directory")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results from an earlier run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per level (the median is reported)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a metric counts as a regression")
+    parser.add_argument("--floor", type=float, default=TIME_FLOOR, help="ignore slowdowns smaller than this many seconds per measurement")
+    parser.add_argument("--blits", type=int, nargs="?", const=100000, help="only measure sprite blits per second for each image format")
+    parser.add_argument("--collision", type=int, nargs="?", const=100000, help="only compare block collision resolving: two passes against TileMap.sweep")
+    parser.add_argument("--startup", type=int, nargs="?", const=5, help="only measure cold start (median of this many runs)")
+    parser.add_argument("--startup-target", type=float, help="fail if cold start to the first frame takes longer (seconds)")
+    args = parser.parse_args(argv)
+
+    if args.blits or args.collision or args.startup:
+        if args.blits:
+            report = run_blits(args.blits)
+        elif args.collision:
+            report = run_collision(args.collision)
+        else:
+            report = run_startup(args.startup, args.startup_target)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+        if args.startup and args.startup_target is not None and report["startup"]["total_seconds"] > args.startup_target:
+            return 1
+
+        return 0
+
+    report = run(args.sizes, args.steps, args.frames, args.levels_dir, args.seed, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if compare(report, baseline, args.tolerance, args.floor):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
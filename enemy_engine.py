@@ -0,0 +1,260 @@
+from contextlib import nullcontext
+
+import numpy as np
+
+# Пакетная симуляция врагов на NumPy. Состояние всех врагов хранится в массивах
+# (structure of arrays), гравитация, движение, столкновения с сеткой блоков,
+# развороты и анимация считаются векторно. Спрайты обновляются только для врагов
+# рядом с экраном, остальные враги существуют только в массивах.
+
+# Кадры анимации меняются раз в столько шагов (как в Enemy.set_images)
+ANIMATION_STEPS = 20
+
+
+def round_half_away(v):
+    # Округление так же, как pygame.Rect при присваивании дробных координат
+    return (np.sign(v) * np.floor(np.abs(v) + 0.5)).astype(np.int64)
+
+
+class EnemyEngine():
+
+    def __init__(self, level, near, margin, profiler=None):
+        # near - расстояние до героя, на котором враги активны (как в Enemy.is_near),
+        # margin - запас вокруг экрана, в котором спрайты синхронизируются с массивами,
+        # profiler - профилировщик кадров (столкновения с блоками - фаза "update.collision")
+        self.level = level
+        self.profiler = profiler
+        self.sprites = list(level.starting_enemies)
+        self.near = near
+        self.margin = margin
+
+        for i, s in enumerate(self.sprites):
+            s.engine_index = i
+
+        tiles = level.tiles
+        self.size = tiles.size
+        self.solid = np.frombuffer(bytes(tiles.tiles), np.uint8).reshape(tiles.rows, tiles.cols) != 0
+
+        n = len(self.sprites)
+        self.w = np.array([s.rect.width for s in self.sprites], np.int64)
+        self.h = np.array([s.rect.height for s in self.sprites], np.int64)
+        self.nframes = np.array([len(s.images_left) for s in self.sprites], np.int64)
+        self.ledges = np.array([s.turns_at_ledges for s in self.sprites], bool)
+
+        self.x = np.zeros(n, np.int64)
+        self.y = np.zeros(n, np.int64)
+        self.vx = np.zeros(n, np.int64)
+        self.vy = np.zeros(n, np.float64)
+        self.image_index = np.zeros(n, np.int64)
+        self.steps = np.zeros(n, np.int64)
+        self.frame = np.zeros(n, np.int64)
+        self.right = np.zeros(n, bool)
+
+        # Враги, которые могут стоять внутри блоков (см. Enemy.embedded)
+        self.embedded = np.zeros(n, bool)
+
+        # Индексы врагов, чьи спрайты сейчас синхронизированы с массивами
+        self.synced = np.arange(0)
+
+        self.load()
+
+    def load(self):
+        # Чтение состояния из спрайтов (после создания или восстановления уровня)
+        for i in range(len(self.sprites)):
+            self.read(i)
+
+        # Сейчас спрайты точно соответствуют массивам
+        self.synced = np.arange(len(self.sprites))
+
+    def is_solid(self, cx, cy):
+        # Есть ли блок в ячейках (вне сетки - пусто)
+        rows, cols = self.solid.shape
+        inside = (cx >= 0) & (cx < cols) & (cy >= 0) & (cy < rows)
+
+        return self.solid[np.clip(cy, 0, rows - 1), np.clip(cx, 0, cols - 1)] & inside
+
+    def sweep(self, idx, axis, d):
+        # Движение врагов idx по оси (0 - x, 1 - y) на d пикселей с остановкой у первого
+        # блока на пути (как TileMap.sweep_axis); возвращает нормали контакта (0, -1 или 1).
+        # Враг не больше клетки, поэтому поперек движения он перекрывает не больше двух ячеек.
+        s = self.size
+
+        if axis == 0:
+            pos, length, lo, width = self.x, self.w[idx], self.y[idx], self.h[idx]
+        else:
+            pos, length, lo, width = self.y, self.h[idx], self.x[idx], self.w[idx]
+
+        start = pos[idx]
+        a0, a1 = lo // s, (lo + width - 1) // s
+        forward = d > 0
+
+        # Линии на пути (как в TileMap.sweep_axis)
+        first = np.where(forward, (start + length) // s, (start - 1) // s)
+        last = np.where(forward, (start + length + d - 1) // s, (start + d) // s)
+        step = np.where(forward, 1, -1)
+        count = np.where(d != 0, (last - first) * step + 1, 0)
+
+        hit = np.zeros(len(idx), bool)
+        line = first.copy()
+
+        for j in range(int(count.max()) if len(idx) else 0):
+            current = first + j * step
+
+            if axis == 0:
+                blocked = self.is_solid(current, a0) | self.is_solid(current, a1)
+            else:
+                blocked = self.is_solid(a0, current) | self.is_solid(a1, current)
+
+            new = blocked & ~hit & (j < count)
+            line[new] = current[new]
+            hit |= new
+
+        pos[idx] = np.where(hit, np.where(forward, line * s - length, (line + 1) * s), start + d)
+
+        return np.where(hit, -step, 0)
+
+    def overlaps(self, idx):
+        # Перекрывают ли враги idx блоки (враг не больше клетки - не больше четырех ячеек)
+        s = self.size
+        x0, x1 = self.x[idx] // s, (self.x[idx] + self.w[idx] - 1) // s
+        y0, y1 = self.y[idx] // s, (self.y[idx] + self.h[idx] - 1) // s
+
+        return (self.is_solid(x0, y0) | self.is_solid(x1, y0) |
+                self.is_solid(x0, y1) | self.is_solid(x1, y1))
+
+    def push_out(self, i):
+        # Враг внутри блоков обрабатывается спрайтом прежним способом (Enemy.push_out);
+        # возвращает нормаль контакта по y
+        s = self.sprites[i]
+        self.write(i)
+        falling = s.vy > 0
+        s.push_out(self.level.tiles)
+        self.read(i)
+
+        return -1 if falling and s.vy == 0 else 0
+
+    def reverse(self, idx):
+        # Разворот врагов idx (как Enemy.reverse)
+        self.vx[idx] *= -1
+        self.right[idx] = self.vx[idx] >= 0
+        self.frame[idx] = self.image_index[idx]
+
+    def step(self, idx, gravity, terminal_velocity, level_width):
+        # Один шаг физики для активных врагов idx
+        s = self.size
+
+        # Гравитация
+        self.vy[idx] = np.minimum(self.vy[idx] + gravity, terminal_velocity)
+
+        with self.profiler.phase("update.collision") if self.profiler else nullcontext():
+            # Враги внутри блоков (только до первого шага вне них)
+            ny = np.zeros(len(idx), np.int64)
+            embedded = self.embedded[idx]
+            stuck = embedded.copy()
+            stuck[embedded] = self.overlaps(idx[embedded])
+            self.embedded[idx[embedded & ~stuck]] = False
+
+            for j in np.flatnonzero(stuck):
+                ny[j] = self.push_out(idx[j])
+
+            free = idx[~stuck]
+
+            # Движение по x и упор в стену
+            nx = self.sweep(free, 0, self.vx[free])
+            self.reverse(free[nx != 0])
+
+            # Движение по y (дробная скорость округляется как в pygame.Rect)
+            ny[~stuck] = self.sweep(free, 1, round_half_away(self.y[free] + self.vy[free]) - self.y[free])
+            self.vy[idx[ny != 0]] = 0
+
+        # Монстры, стоящие на блоке, разворачиваются, если под передним краем пусто
+        # (как Monster.fall); у границы уровня разворачиваются один раз - ниже, при упоре в границу
+        vx = self.vx[idx]
+        front = np.where(vx > 0, self.x[idx] + self.w[idx] - 1, self.x[idx]) // s
+        below = (self.y[idx] + self.h[idx]) // s
+        outside = (front < 0) | (front >= self.solid.shape[1])
+        supported = self.is_solid(front, below) & ~self.is_solid(front, below - 1)
+        self.reverse(idx[self.ledges[idx] & (ny < 0) & ~supported & ~outside])
+
+        # Границы мира
+        m = self.x[idx] < 0
+        self.x[idx[m]] = 0
+        self.reverse(idx[m])
+
+        m = self.x[idx] + self.w[idx] > level_width
+        self.x[idx[m]] = level_width - self.w[idx[m]]
+        self.reverse(idx[m])
+
+        # Анимация
+        m = self.steps[idx] == 0
+        self.frame[idx[m]] = self.image_index[idx[m]]
+        self.image_index[idx[m]] = (self.image_index[idx[m]] + 1) % self.nframes[idx[m]]
+        self.steps[idx] = (self.steps[idx] + 1) % ANIMATION_STEPS
+
+    def update(self, hero, view, awake=None):
+        # Шаг симуляции. awake - спрайты неспящих врагов (см. Level.activity),
+        # по умолчанию проверяются все
+        if awake is None:
+            active = np.arange(len(self.sprites))
+        else:
+            active = np.fromiter((s.engine_index for s in awake), np.int64, len(awake))
+
+        level = self.level
+        idx = active[np.abs(self.x[active] - hero.rect.x) < self.near]
+
+        bucket_width = level.activity.bucket_width
+        before = self.x[idx] // bucket_width
+        self.step(idx, level.gravity, level.terminal_velocity, level.width)
+
+        # Враги, перешедшие в другую колонку индекса активности
+        for i in idx[self.x[idx] // bucket_width != before]:
+            level.activity.move(self.sprites[i], int(self.x[i]))
+
+        self.sync(view, active)
+
+    def sync(self, view, candidates=None):
+        # Перенос состояния в спрайты рядом с экраном; ушедшие из этой зоны
+        # убираются из пространственного хеша, чтобы не рисоваться и не сталкиваться.
+        # Проверяются только candidates и уже синхронизированные враги.
+        if candidates is None:
+            candidates = np.arange(len(self.sprites))
+
+        idx = np.union1d(candidates, self.synced)
+        zone = view.inflate(2 * self.margin, 2 * self.margin)
+        x, y = self.x[idx], self.y[idx]
+        near = idx[(x < zone.right) & (x + self.w[idx] > zone.left) &
+                   (y < zone.bottom) & (y + self.h[idx] > zone.top)]
+        index = self.level.enemy_hash
+
+        for i in near:
+            self.write(i)
+            index.add(self.sprites[i])
+            index.move(self.sprites[i])
+
+        for i in np.setdiff1d(self.synced, near):
+            index.remove(self.sprites[i])
+
+        self.synced = near
+
+    def sync_all(self):
+        # Перенос состояния во все спрайты (например, перед снимком уровня)
+        for i in range(len(self.sprites)):
+            self.write(i)
+
+    def read(self, i):
+        s = self.sprites[i]
+        self.x[i], self.y[i] = s.rect.x, s.rect.y
+        self.vx[i], self.vy[i] = s.vx, s.vy
+        self.image_index[i], self.steps[i] = s.image_index, s.steps
+        self.right[i] = s.current_images is s.images_right
+        self.frame[i] = s.frame
+        self.embedded[i] = s.embedded
+
+    def write(self, i):
+        s = self.sprites[i]
+        s.rect.x, s.rect.y = int(self.x[i]), int(self.y[i])
+        s.vx, s.vy = int(self.vx[i]), float(self.vy[i])
+        s.image_index, s.steps = int(self.image_index[i]), int(self.steps[i])
+        s.current_images = s.images_right if self.right[i] else s.images_left
+        s.set_frame(int(self.frame[i]))
+        s.embedded = bool(self.embedded[i])
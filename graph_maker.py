@@ -1,56 +1,486 @@
+# Level viewer/editor for levels/*.json
+#
+#   python graph_maker.py levels/world-1.json
+#   python graph_maker.py levels/new.json --size 200 10
+#
+# Mouse: left button paints the current brush, right button erases a cell,
+# middle button drags the view, wheel zooms around the cursor.
+# Keys: arrows scroll, Tab / Shift+Tab change the brush, 1-9 pick a tile,
+# G toggles the grid, Ctrl+S saves.
+
 # Imports
-import pygame
+import argparse
+import json
+import os
+import sys
 
+import pygame
 
-# Initialize game engine
-pygame.init()
+import level_cache
+import main
 
 
 # Window
 WIDTH = 36 * 32
-HEIGHT = 10 * 32
+HEIGHT = 20 * 32
 SIZE = ([WIDTH, HEIGHT])
-TITLE = "_____________________________________"
-screen = pygame.display.set_mode(SIZE)
-pygame.display.set_caption(TITLE)
+TITLE = "Level editor"
 
 
 # Timer
-clock = pygame.time.Clock()
 refresh_rate = 60
 
 
 # Colors
 WHITE = (255, 255, 255)
 GRAY = (175, 175, 175)
+OUTSIDE = (40, 40, 40)
+CURSOR = (255, 64, 64)
+
+
+# View: cell sizes in pixels for each zoom step, grid is hidden below GRID_MIN_ZOOM
+ZOOMS = [4, 8, 16, 32, 64]
+GRID_MIN_ZOOM = 8
+SCROLL_SPEED = 16
+
+# Map is drawn in chunks of CHUNK_CELLS x CHUNK_CELLS cells, cached up to CHUNK_BUDGET bytes
+CHUNK_CELLS = 32
+CHUNK_BUDGET = 64 * 1024 * 1024
+
+
+# Entity overlays (spawn table -> image), the first flag cell is the flag itself
+entity_images = {"bears": main.bear_images[0],
+                 "monsters": main.monster_images[0],
+                 "coins": main.coin_img,
+                 "oneups": main.oneup_img,
+                 "hearts": main.heart_img,
+                 "flag": main.flagpole_img}
+
+# Brushes: tiles, entities and the hero start cell
+BRUSHES = main.TILE_CODES + level_cache.SPAWN_TABLES + ["start"]
+
+
+class LevelDocument():
+    # Level data being edited: block grid (see level_cache.build_grid),
+    # spawn tables and an index of entities by cell
+
+    def __init__(self, path, size=(36, 10)):
+        self.path = path
+
+        if os.path.exists(path):
+            self.map_data = level_cache.load(path)
+        else:
+            self.map_data = {"name": os.path.splitext(os.path.basename(path))[0],
+                             "width": size[0],
+                             "height": size[1],
+                             "background-color": [130, 182, 255],
+                             "parallax": [],
+                             "music": "",
+                             "start": [1, size[1] - 2],
+                             "gravity": 1.0,
+                             "terminal-velocity": 32,
+                             "blocks": []}
+            self.map_data['grid'] = level_cache.build_grid(self.map_data)
+
+        self.cols, self.rows, codes, tiles, order = self.map_data.pop('grid')
+
+        # Codes are renumbered to TILE_CODES so that any tile can be painted
+        remap = bytes([0] + [main.TILE_CODES.index(c) + 1 for c in codes])
+        self.tiles = tiles.translate(remap + bytes(256 - len(remap)))
+        self.order = order
+        self.next_order = len(tiles) and max(order) + 1
+
+        self.spawns = {name: [list(item[:2]) for item in self.map_data.get(name, [])]
+                       for name in level_cache.SPAWN_TABLES}
+        self.entities = {}
+
+        for name in level_cache.SPAWN_TABLES:
+            for x, y in self.spawns[name]:
+                self.entities.setdefault((x, y), []).append(name)
+
+        self.modified = False
+
+    def inside(self, x, y):
+        return 0 <= x < self.cols and 0 <= y < self.rows
+
+    def code_at(self, x, y):
+        t = self.tiles[y * self.cols + x]
+
+        return main.TILE_CODES[t - 1] if t else None
+
+    def set_tile(self, x, y, code):
+        # Returns True if the cell changed
+        i = y * self.cols + x
+        t = main.TILE_CODES.index(code) + 1 if code else 0
+
+        if self.tiles[i] == t:
+            return False
+
+        if t and not self.tiles[i]:
+            self.order[i] = self.next_order
+            self.next_order += 1
+
+        self.tiles[i] = t
+        self.modified = True
+
+        return True
+
+    def add_entity(self, x, y, name):
+        names = self.entities.setdefault((x, y), [])
+
+        if name in names:
+            return False
+
+        names.append(name)
+        self.spawns[name].append([x, y])
+        self.modified = True
+
+        return True
+
+    def clear_entities(self, x, y):
+        names = self.entities.pop((x, y), [])
+
+        for name in names:
+            self.spawns[name].remove([x, y])
+
+        self.modified = self.modified or bool(names)
+
+        return bool(names)
+
+    def set_start(self, x, y):
+        # Returns the old start cell
+        old = tuple(self.map_data['start'])
+        self.map_data['start'] = [x, y]
+        self.modified = self.modified or old != (x, y)
+
+        return old
+
+    def to_json(self):
+        # Blocks are written in their original order, new blocks at the end
+        cells = [i for i, t in enumerate(self.tiles) if t]
+        cells.sort(key=self.order.__getitem__)
+
+        data = dict(self.map_data)
+        data['blocks'] = [[i % self.cols, i // self.cols, main.TILE_CODES[self.tiles[i] - 1]] for i in cells]
+        data.update(self.spawns)
+
+        return data
+
+    def save(self, path=None):
+        # Atomic write, like compiled levels; an old .lvc file becomes stale by its mtime
+        path = path or self.path
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_json(), f)
+
+        os.replace(tmp_path, path)
+        self.modified = False
+
+
+class Editor():
+    # View of a LevelDocument: camera, zoom, chunk cache and the list of screen
+    # rects to update. Edits repaint only the changed cell on its cached chunk.
+
+    def __init__(self, document, size=SIZE):
+        self.doc = document
+        self.width, self.height = size
+        self.zoom = ZOOMS.index(32)
+        self.camera = [0, 0]
+        self.grid = True
+        self.brush = 0
+        self.cursor = None
+        self.chunks = main.ChunkCache(CHUNK_BUDGET)
+        self.grid_tiles = {}
+        self.background = tuple(document.map_data.get('background-color', WHITE))
+
+        # Screen rects to update; None - whole screen
+        self.dirty = None
+
+    @property
+    def cell(self):
+        return ZOOMS[self.zoom]
+
+    def cell_at(self, pos):
+        s = self.cell
+
+        return (pos[0] + self.camera[0]) // s, (pos[1] + self.camera[1]) // s
+
+    def cell_rect(self, x, y):
+        # Cell rect on screen
+        s = self.cell
+
+        return pygame.Rect(x * s - self.camera[0], y * s - self.camera[1], s, s)
+
+    def invalidate(self, rect=None):
+        if rect is None:
+            self.dirty = None
+        elif self.dirty is not None:
+            self.dirty.append(rect)
+
+    def scroll(self, dx, dy):
+        s = self.cell
+        x = min(max(self.camera[0] + dx, -self.width // 2), self.doc.cols * s - self.width // 2)
+        y = min(max(self.camera[1] + dy, -self.height // 2), self.doc.rows * s - self.height // 2)
+
+        if [x, y] != self.camera:
+            self.camera = [x, y]
+            self.invalidate()
+
+    def zoom_at(self, pos, step):
+        # Zoom keeping the point under pos in place
+        zoom = min(max(self.zoom + step, 0), len(ZOOMS) - 1)
+
+        if zoom == self.zoom:
+            return
+
+        old, new = self.cell, ZOOMS[zoom]
+        self.zoom = zoom
+        self.camera = [(pos[0] + self.camera[0]) * new // old - pos[0],
+                       (pos[1] + self.camera[1]) * new // old - pos[1]]
+        self.scroll(0, 0)
+        self.invalidate()
+
+    def image(self, path, s):
+        return main.assets.image(path, (s, s))
+
+    def paint_cells(self, surface, x0, y0, x1, y1, origin):
+        # Cells [x0, x1) x [y0, y1) on surface, origin - screen position of cell (x0, y0)
+        s = self.cell
+        doc = self.doc
+        tiles = [self.image(main.block_images[code], s) for code in main.TILE_CODES]
+        start = tuple(doc.map_data['start'])
+        flag = tuple(doc.spawns['flag'][0]) if doc.spawns['flag'] else None
+
+        surface.fill(self.background, (origin[0], origin[1], (x1 - x0) * s, (y1 - y0) * s))
+
+        for y in range(y0, y1):
+            row = y * doc.cols
+            py = origin[1] + (y - y0) * s
+
+            for x in range(x0, x1):
+                t = doc.tiles[row + x]
+                names = doc.entities.get((x, y))
+                px = origin[0] + (x - x0) * s
+
+                if t:
+                    surface.blit(tiles[t - 1], (px, py))
+
+                if names:
+                    for name in names:
+                        path = main.flag_img if name == "flag" and (x, y) == flag else entity_images[name]
+                        surface.blit(self.image(path, s), (px, py))
+
+                if (x, y) == start:
+                    surface.blit(self.image(main.hero_images['idle'], s), (px, py))
+
+    def build_chunk(self, cx, cy):
+        x0, y0 = cx * CHUNK_CELLS, cy * CHUNK_CELLS
+        x1, y1 = min(x0 + CHUNK_CELLS, self.doc.cols), min(y0 + CHUNK_CELLS, self.doc.rows)
+        surface = pygame.Surface(((x1 - x0) * self.cell, (y1 - y0) * self.cell)).convert()
+        self.paint_cells(surface, x0, y0, x1, y1, (0, 0))
+
+        return surface
+
+    def touch(self, x, y):
+        # Cell changed: repaint it on the cached chunk of the current zoom,
+        # drop the chunk at other zooms and mark the cell on screen
+        cx, cy = x // CHUNK_CELLS, y // CHUNK_CELLS
+
+        for zoom in range(len(ZOOMS)):
+            if zoom != self.zoom:
+                self.chunks.discard((zoom, cx, cy))
+
+        chunk = self.chunks.peek((self.zoom, cx, cy))
+
+        if chunk is not None:
+            s = self.cell
+            self.paint_cells(chunk, x, y, x + 1, y + 1, ((x - cx * CHUNK_CELLS) * s, (y - cy * CHUNK_CELLS) * s))
+
+        self.invalidate(self.cell_rect(x, y))
+
+    def apply(self, pos, erase=False):
+        # Brush (or eraser) at a screen position
+        x, y = self.cell_at(pos)
+
+        if not self.doc.inside(x, y):
+            return
+
+        brush = BRUSHES[self.brush]
+        flags = self.doc.spawns['flag']
+        flag = flags[0] if flags else None
+        changed = False
+
+        if erase:
+            changed = self.doc.set_tile(x, y, None)
+            changed = self.doc.clear_entities(x, y) or changed
+        elif brush in main.TILE_CODES:
+            changed = self.doc.set_tile(x, y, brush)
+        elif brush == "start":
+            old = self.doc.set_start(x, y)
+
+            if old != (x, y):
+                self.touch(*old)
+                changed = True
+        else:
+            changed = self.doc.add_entity(x, y, brush)
+
+        if changed:
+            self.touch(x, y)
+
+        # The flag image is drawn on the first flag cell
+        if flags and flags[0] != flag:
+            self.touch(*flags[0])
+
+    def move_cursor(self, pos):
+        cell = self.cell_at(pos)
+
+        if cell != self.cursor:
+            if self.cursor is not None:
+                self.invalidate(self.cell_rect(*self.cursor).inflate(2, 2))
+
+            self.cursor = cell
+            self.invalidate(self.cell_rect(*cell).inflate(2, 2))
+
+    def grid_tile(self):
+        # Grid lines for the whole screen, rendered once per zoom
+        # and blitted with the camera offset modulo the cell size
+        s = self.cell
+
+        if s not in self.grid_tiles:
+            surface = pygame.Surface((self.width + s, self.height + s))
+            surface.fill(WHITE)
+            surface.set_colorkey(WHITE)
+
+            for x in range(0, self.width + s, s):
+                pygame.draw.line(surface, GRAY, [x, 0], [x, self.height + s], 1)
+
+            for y in range(0, self.height + s, s):
+                pygame.draw.line(surface, GRAY, [0, y], [self.width + s, y], 1)
+
+            self.grid_tiles[s] = surface.convert()
+
+        return self.grid_tiles[s]
+
+    def draw_area(self, surface, area):
+        # Visible chunks, grid and cursor inside a screen rect
+        s = self.cell
+        size = CHUNK_CELLS * s
+        cam_x, cam_y = self.camera
+        level = pygame.Rect(-cam_x, -cam_y, self.doc.cols * s, self.doc.rows * s)
+
+        surface.set_clip(area)
+        surface.fill(OUTSIDE)
+
+        view = area.clip(level).move(cam_x, cam_y)
+
+        if view.width > 0 and view.height > 0:
+            for cy in range(view.top // size, (view.bottom - 1) // size + 1):
+                for cx in range(view.left // size, (view.right - 1) // size + 1):
+                    chunk = self.chunks.get((self.zoom, cx, cy), lambda: self.build_chunk(cx, cy))
+                    surface.blit(chunk, (cx * size - cam_x, cy * size - cam_y))
+
+        if self.grid and s >= GRID_MIN_ZOOM:
+            surface.set_clip(area.clip(level))
+            surface.blit(self.grid_tile(), (-(cam_x % s), -(cam_y % s)))
+
+        if self.cursor is not None and self.doc.inside(*self.cursor):
+            surface.set_clip(area)
+            pygame.draw.rect(surface, CURSOR, self.cell_rect(*self.cursor), 2)
+
+        surface.set_clip(None)
+
+    def draw(self, surface):
+        # Redraw what changed; returns screen rects to update
+        self.chunks.begin_frame()
+
+        if self.dirty is None:
+            rects = [surface.get_rect()]
+        else:
+            rects = main.merge_rects(r.clip(surface.get_rect()) for r in self.dirty)
+
+        for rect in rects:
+            self.draw_area(surface, rect)
+
+        self.dirty = []
+
+        return rects
+
+    def caption(self):
+        cursor = "(%d, %d)" % self.cursor if self.cursor else ""
+
+        return "%s - %s%s - brush %s - zoom %d - %dx%d %s" % (TITLE, self.doc.path, "*" if self.doc.modified else "",
+                                                          BRUSHES[self.brush], self.cell, self.doc.cols, self.doc.rows, cursor)
+
+
+def run(path, size):
+    screen = pygame.display.set_mode(SIZE)
+    clock = pygame.time.Clock()
+    editor = Editor(LevelDocument(path, size))
+    caption = None
+
+    # Game loop
+    done = False
+
+    while not done:
+        # Event processing
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                done = True
+
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_s and event.mod & pygame.KMOD_CTRL:
+                    editor.doc.save()
+                elif event.key == pygame.K_TAB:
+                    step = -1 if event.mod & pygame.KMOD_SHIFT else 1
+                    editor.brush = (editor.brush + step) % len(BRUSHES)
+                elif pygame.K_1 <= event.key <= pygame.K_9:
+                    editor.brush = event.key - pygame.K_1
+                elif event.key == pygame.K_g:
+                    editor.grid = not editor.grid
+                    editor.invalidate()
+
+            elif event.type == pygame.MOUSEWHEEL:
+                editor.zoom_at(pygame.mouse.get_pos(), event.y)
+
+            elif event.type == pygame.MOUSEMOTION:
+                if event.buttons[1]:
+                    editor.scroll(-event.rel[0], -event.rel[1])
+
+                editor.move_cursor(event.pos)
 
-# Game loop
-done = False
+                if event.buttons[0] or event.buttons[2]:
+                    editor.apply(event.pos, erase=event.buttons[2])
 
-while not done:
-    # Event processing
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            done = True
-            
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
+                editor.apply(event.pos, erase=event.button == 3)
 
-    # Drawing code
-    screen.fill(WHITE)
+        keys = pygame.key.get_pressed()
+        editor.scroll(SCROLL_SPEED * (keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]),
+                      SCROLL_SPEED * (keys[pygame.K_DOWN] - keys[pygame.K_UP]))
 
-    for x in range(0, WIDTH, 32):
-        pygame.draw.line(screen, GRAY, [x, 0], [x, HEIGHT], 1)
+        # Drawing code: only changed parts of the screen
+        rects = editor.draw(screen)
 
-    for y in range(0, HEIGHT, 32):
-        pygame.draw.line(screen, GRAY, [0, y], [WIDTH, y], 1)
+        if rects:
+            pygame.display.update(rects)
 
+        if editor.caption() != caption:
+            caption = editor.caption()
+            pygame.display.set_caption(caption)
 
-    # Update screen (Actually draw the picture in the window.)
-    pygame.display.flip()
+        # Limit refresh rate of game loop
+        clock.tick(refresh_rate)
 
 
-    # Limit refresh rate of game loop 
-    clock.tick(refresh_rate)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="View and edit level JSON files.")
+    parser.add_argument("path", help="level JSON file (created if missing)")
+    parser.add_argument("--size", type=int, nargs=2, default=[36, 10], metavar=("COLS", "ROWS"), help="size of a new level")
+    args = parser.parse_args()
 
+    run(args.path, args.size)
 
-# Close window and quit
-pygame.quit()
+    # Close window and quit
+    pygame.quit()
+    sys.exit()
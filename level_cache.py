@@ -0,0 +1,176 @@
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+# Скомпилированные уровни: двоичный файл рядом с JSON (levels/world-1.json -> levels/world-1.lvc).
+# В нем хранятся параметры уровня, готовая сетка блоков и таблицы появления объектов,
+# так что при загрузке не нужно разбирать JSON и заново строить сетку.
+
+MAGIC = b"LVC\x01"
+EXTENSION = ".lvc"
+
+# Таблицы объектов уровня (списки координат [x, y] в клетках)
+SPAWN_TABLES = ["bears", "monsters", "coins", "oneups", "hearts", "flag"]
+
+
+def compiled_path(json_path):
+    # Путь к скомпилированному файлу уровня
+    return os.path.splitext(json_path)[0] + EXTENSION
+
+
+def build_grid(map_data):
+    # Сетка блоков из списка 'blocks': (cols, rows, codes, tiles, order).
+    # tiles - коды ячеек (0 - пусто, иначе индекс в codes + 1),
+    # order - порядок, в котором блоки перечислены в уровне.
+    blocks = map_data['blocks']
+    cols = max([map_data['width']] + [item[0] + 1 for item in blocks])
+    rows = max([map_data['height']] + [item[1] + 1 for item in blocks])
+
+    codes = []
+    tiles = bytearray(cols * rows)
+    order = array('I', [0]) * (cols * rows)
+
+    for n, (cx, cy, code) in enumerate(blocks):
+        if cx < 0 or cy < 0:
+            raise ValueError("block (%d, %d) is outside the level grid" % (cx, cy))
+
+        if code not in codes:
+            codes.append(code)
+
+        i = cy * cols + cx
+        tiles[i] = codes.index(code) + 1
+        order[i] = n
+
+    return cols, rows, codes, tiles, order
+
+
+def to_little_endian(a):
+    # Массивы в файле всегда little-endian
+    if sys.byteorder != "little":
+        a = array(a.typecode, a)
+        a.byteswap()
+
+    return a
+
+
+def compile_level(json_path, out_path=None):
+    # Компиляция JSON-уровня в двоичный файл, возвращает путь к нему
+    out_path = out_path or compiled_path(json_path)
+
+    with open(json_path, 'r') as f:
+        map_data = json.load(f)
+
+    cols, rows, codes, tiles, order = build_grid(map_data)
+
+    header = {k: v for k, v in map_data.items() if k != 'blocks' and k not in SPAWN_TABLES}
+    header['codes'] = codes
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    parts = [struct.pack("<I", len(header_bytes)), header_bytes,
+             struct.pack("<II", cols, rows), bytes(tiles), to_little_endian(order).tobytes()]
+
+    for name in SPAWN_TABLES:
+        coords = array('i', [c for item in map_data.get(name, []) for c in item[:2]])
+        parts.append(struct.pack("<I", len(coords) // 2))
+        parts.append(to_little_endian(coords).tobytes())
+
+    # Запись через временный файл, чтобы игра не прочитала недописанный уровень
+    tmp_path = out_path + ".tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(zlib.compress(b"".join(parts)))
+
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+def read_compiled(path):
+    # Чтение скомпилированного уровня в словарь того же вида, что и load()
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a compiled level" % path)
+
+    data = memoryview(zlib.decompress(data[len(MAGIC):]))
+    pos = 0
+
+    def take(n):
+        nonlocal pos
+        chunk = data[pos:pos + n]
+        pos += n
+        return chunk
+
+    def take_array(typecode, count):
+        a = array(typecode)
+        a.frombytes(take(count * a.itemsize))
+
+        if sys.byteorder != "little":
+            a.byteswap()
+
+        return a
+
+    header_len, = struct.unpack("<I", take(4))
+    map_data = json.loads(bytes(take(header_len)).decode("utf-8"))
+
+    cols, rows = struct.unpack("<II", take(8))
+    tiles = bytearray(take(cols * rows))
+    order = take_array('I', cols * rows)
+    map_data['grid'] = (cols, rows, map_data.pop('codes'), tiles, order)
+
+    for name in SPAWN_TABLES:
+        count, = struct.unpack("<I", take(4))
+        coords = take_array('i', 2 * count)
+        map_data[name] = list(zip(coords[0::2], coords[1::2]))
+
+    return map_data
+
+
+def is_fresh(json_path):
+    # Скомпилированный файл существует и не старше исходного JSON
+    path = compiled_path(json_path)
+
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(json_path)
+
+
+def load(json_path):
+    # Данные уровня: из скомпилированного файла, если он свежий, иначе из JSON.
+    # В обоих случаях в результате есть готовая сетка 'grid' (см. build_grid).
+    if is_fresh(json_path):
+        try:
+            return read_compiled(compiled_path(json_path))
+        except (ValueError, struct.error, zlib.error):
+            pass
+
+    with open(json_path, 'r') as f:
+        map_data = json.load(f)
+
+    map_data['grid'] = build_grid(map_data)
+
+    return map_data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile level JSON files into binary level caches.")
+    parser.add_argument("paths", nargs="*", help="level JSON files (default: levels/*.json)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    paths = args.paths or sorted(glob.glob("levels/*.json"))
+
+    # Уровни компилируются параллельно на всех ядрах
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for json_path, out_path in zip(paths, pool.map(compile_level, paths)):
+            print("%s -> %s (%d bytes)" % (json_path, out_path, os.path.getsize(out_path)))
+
+
+if __name__ == "__main__":
+    main()
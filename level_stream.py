@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from level_cache import SPAWN_TABLES, build_grid, to_little_endian
+
+# Потоковый формат уровней для очень длинных миров (levels/big.json -> levels/big.lvs).
+# Уровень делится на чанки по CHUNK_COLS столбцов; в каждом чанке свои блоки и объекты,
+# сжатые отдельно. Заголовок хранит параметры уровня и смещения чанков в файле,
+# так что игра читает только чанки рядом с камерой.
+
+MAGIC = b"LVS\x01"
+EXTENSION = ".lvs"
+
+# Ширина чанка в клетках
+CHUNK_COLS = 16
+
+
+def streamed_path(json_path):
+    # Путь к потоковому файлу уровня
+    return os.path.splitext(json_path)[0] + EXTENSION
+
+
+def is_streamed(path):
+    return path.endswith(EXTENSION)
+
+
+def convert(json_path, out_path=None, chunk_cols=CHUNK_COLS):
+    # Перевод JSON-уровня в потоковый формат, возвращает путь к файлу
+    out_path = out_path or streamed_path(json_path)
+
+    with open(json_path, 'r') as f:
+        map_data = json.load(f)
+
+    cols, rows, codes, tiles, order = build_grid(map_data)
+    count = (cols + chunk_cols - 1) // chunk_cols
+
+    # Объекты раскладываются по чанкам по столбцу клетки
+    spawns = [{name: [] for name in SPAWN_TABLES} for i in range(count)]
+
+    for name in SPAWN_TABLES:
+        for item in map_data.get(name, []):
+            k = min(max(item[0] // chunk_cols, 0), count - 1)
+            spawns[k][name].append(item[:2])
+
+    blobs = []
+
+    for k in range(count):
+        x0 = k * chunk_cols
+        w = min(chunk_cols, cols - x0)
+        chunk_tiles = bytearray()
+        chunk_order = array('I')
+
+        for y in range(rows):
+            chunk_tiles += tiles[y * cols + x0:y * cols + x0 + w]
+            chunk_order.extend(order[y * cols + x0:y * cols + x0 + w])
+
+        parts = [struct.pack("<I", w), bytes(chunk_tiles), to_little_endian(chunk_order).tobytes()]
+
+        for name in SPAWN_TABLES:
+            coords = array('i', [c for item in spawns[k][name] for c in item])
+            parts.append(struct.pack("<I", len(coords) // 2))
+            parts.append(to_little_endian(coords).tobytes())
+
+        blobs.append(zlib.compress(b"".join(parts)))
+
+    header = {k: v for k, v in map_data.items() if k != 'blocks' and k not in SPAWN_TABLES}
+    header.update(codes=codes, cols=cols, rows=rows, chunk_cols=chunk_cols, chunks=[len(b) for b in blobs])
+
+    # Клетка полотнища флага (остальные клетки флага - древко)
+    if map_data.get('flag'):
+        header['flag-top'] = list(map_data['flag'][0][:2])
+
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    # Запись через временный файл, как и у скомпилированных уровней
+    tmp_path = out_path + ".tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+
+        for blob in blobs:
+            f.write(blob)
+
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+class StreamReader():
+    # Чтение потокового уровня: заголовок сразу, чанки - по запросу
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a streamed level" % path)
+
+            header_len, = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+
+        self.cols = self.header['cols']
+        self.rows = self.header['rows']
+        self.chunk_cols = self.header['chunk_cols']
+        self.codes = self.header['codes']
+
+        # Смещения чанков в файле
+        self.offsets = []
+        pos = len(MAGIC) + 4 + header_len
+
+        for size in self.header['chunks']:
+            self.offsets.append((pos, size))
+            pos += size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read_chunk(self, k):
+        # Данные чанка k: 'grid' в формате level_cache.build_grid (столбцы чанка)
+        # и таблицы объектов в клетках уровня
+        offset, size = self.offsets[k]
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = memoryview(zlib.decompress(f.read(size)))
+
+        w, = struct.unpack("<I", data[:4])
+        pos = 4 + w * self.rows
+        tiles = bytearray(data[4:pos])
+        order = array('I')
+        order.frombytes(data[pos:pos + 4 * w * self.rows])
+        pos += 4 * w * self.rows
+
+        if sys.byteorder != "little":
+            order.byteswap()
+
+        chunk = {'grid': (w, self.rows, self.codes, tiles, order)}
+
+        for name in SPAWN_TABLES:
+            count, = struct.unpack("<I", data[pos:pos + 4])
+            coords = array('i')
+            coords.frombytes(data[pos + 4:pos + 4 + 8 * count])
+            pos += 4 + 8 * count
+
+            if sys.byteorder != "little":
+                coords.byteswap()
+
+            chunk[name] = list(zip(coords[0::2], coords[1::2]))
+
+        return chunk
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert level JSON files into the chunked streaming format.")
+    parser.add_argument("paths", nargs="+", help="level JSON files")
+    parser.add_argument("--chunk-cols", type=int, default=CHUNK_COLS, help="chunk width in tiles")
+    args = parser.parse_args(argv)
+
+    for json_path in args.paths:
+        out_path = convert(json_path, chunk_cols=args.chunk_cols)
+        print("%s -> %s (%d bytes)" % (json_path, out_path, os.path.getsize(out_path)))
+
+
+if __name__ == "__main__":
+    main()
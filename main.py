@@ -1,10 +1,29 @@
-import json
+import argparse
+import hashlib
+import os
 import pygame
+import re
+import struct
 import sys
-
-# Инициализация Pygame
-pygame.mixer.pre_init()
-pygame.init()
+import level_cache
+import level_stream
+import profiler
+import replay
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Необязательный пакетный движок врагов (нужен NumPy)
+try:
+    import enemy_engine
+except ImportError:
+    enemy_engine = None
+
+# Pygame инициализируется при создании игры (init()), а не при импорте:
+# уровни, персонажи и враги работают без окна и звука
 
 # Настройки окна
 TITLE = "Platformer"
@@ -13,13 +32,49 @@ HEIGHT = 640
 FPS = 60
 GRID_SIZE = 64
 
+# Чанки статических слоев
+CHUNK_SIZE = 8 * GRID_SIZE
+CHUNK_BUDGET = 64 * 1024 * 1024
+
+# Перерисовывать только изменившиеся области экрана, если камера не двигалась
+DIRTY_RECTS = True
+
+# Бюджет памяти на построенные уровни в кеше (байт)
+LEVEL_CACHE_BUDGET = 256 * 1024 * 1024
+
+# Потоковые уровни: чанки загружаются в этом радиусе от центра экрана
+# и выгружаются дальше второго радиуса (пикселей).
+# STREAM_RADIUS должен быть больше радиуса активности врагов (2 * WIDTH, см. Enemy.is_near)
+# плюс смещение центра экрана от героя (до WIDTH / 2): незагруженные столбцы
+# при столкновениях считаются пустыми, и активные враги за ними провалятся вниз
+STREAM_RADIUS = 3 * WIDTH
+STREAM_UNLOAD_RADIUS = 4 * WIDTH
+
+# Симулировать врагов пакетно в массивах NumPy (для уровней с тысячами врагов)
+BATCH_ENEMIES = False
+
+# Отрисовка в отдельном потоке: симуляция считает следующий кадр,
+# пока поток отрисовки собирает предыдущий (см. RenderThread)
+PIPELINED_RENDER = False
 
 # Управление
 LEFT = pygame.K_LEFT
 RIGHT = pygame.K_RIGHT
 JUMP = pygame.K_SPACE
 
-# Уровни
+# Удерживаемые клавиши, которые сохраняются в записи ввода
+RECORDED_KEYS = (LEFT, RIGHT, JUMP)
+
+# Отладочные клавиши профилировщика: оверлей, запись cProfile, экспорт кадров в CSV/JSON
+PROFILER_OVERLAY = pygame.K_F3
+PROFILER_CAPTURE = pygame.K_F4
+PROFILER_EXPORT = pygame.K_F5
+
+# Папка для файлов профилировщика
+PROFILES_DIR = "profiles"
+
+# Уровни: JSON или потоковые .lvs (python level_stream.py levels/big.json);
+# из командной строки список заменяется через --level
 levels = ["levels/world-1.json",
           "levels/world-2.json",
           "levels/world-3.json"]
@@ -29,50 +84,411 @@ TRANSPARENT = (0, 0, 0, 0)
 DARK_BLUE = (16, 86, 103)
 WHITE = (255, 255, 255)
 
-# Шрифты
-FONT_SM = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", 32)
-FONT_MD = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", 64)
-FONT_LG = pygame.font.Font("assets/fonts/thats_super.ttf", 72)
+# Шрифты: (файл, размер), загружаются при первом использовании (load_font)
+FONT_SM = ("assets/fonts/minya_nouvelle_bd.ttf", 32)
+FONT_MD = ("assets/fonts/minya_nouvelle_bd.ttf", 64)
+FONT_LG = ("assets/fonts/thats_super.ttf", 72)
+FONT_PROFILER = (None, 20)
+
+# Размер кеша отрендеренного текста
+TEXT_CACHE_SIZE = 64
+
+# RLE-ускорение изображений с прозрачностью (рисуются в несколько раз быстрее,
+# полупрозрачные края могут отличаться на 1 по каналу)
+SPRITE_RLE = True
+
+# Упаковка спрайтов в общие атласы (подповерхности атласа вместо отдельных изображений).
+# При программной отрисовке SDL быстрее отдельные изображения с RLE, см. benchmark.py --blits
+SPRITE_ATLAS = False
+ATLAS_SIZE = 1024
+
+# Звук: каналы для эффектов и громкость (0..1)
+SOUND_CHANNELS = 8
+SOUND_VOLUME = 0.7
+MUSIC_VOLUME = 0.5
 
 # Вспомогательные функции
-def load_image(file_path, width=GRID_SIZE, height=GRID_SIZE):
-    # Загрузка изображения и масштабирование
-    img = pygame.image.load(file_path)
-    img = pygame.transform.scale(img, (width, height))
-    return img
-
-
-# Изображения
-hero_walk1 = load_image("assets/character/adventurer_walk1.png")
-hero_walk2 = load_image("assets/character/adventurer_walk2.png")
-hero_jump = load_image("assets/character/adventurer_jump.png")
-hero_idle = load_image("assets/character/adventurer_idle.png")
-hero_images = {"run": [hero_walk1, hero_walk2],
-               "jump": hero_jump,
-               "idle": hero_idle}
-
-block_images = {"TL": load_image("assets/tiles/top_left.png"),
-                "TM": load_image("assets/tiles/top_middle.png"),
-                "TR": load_image("assets/tiles/top_right.png"),
-                "ER": load_image("assets/tiles/end_right.png"),
-                "EL": load_image("assets/tiles/end_left.png"),
-                "TP": load_image("assets/tiles/top.png"),
-                "CN": load_image("assets/tiles/center.png"),
-                "LF": load_image("assets/tiles/lone_float.png"),
-                "SP": load_image("assets/tiles/special.png")}
-
-coin_img = load_image("assets/items/coin.png")
-heart_img = load_image("assets/items/bandaid.png")
-oneup_img = load_image("assets/items/first_aid.png")
-flag_img = load_image("assets/items/flag.png")
-flagpole_img = load_image("assets/items/flagpole.png")
-
-monster_img1 = load_image("assets/enemies/monster-1.png")
-monster_img2 = load_image("assets/enemies/monster-2.png")
-monster_images = [monster_img1, monster_img2]
-
-bear_img = load_image("assets/enemies/bear-1.png")
-bear_images = [bear_img]
+def init(headless=False):
+    # Инициализация pygame (повторный вызов ничего не делает).
+    # headless - видеодрайвер SDL "dummy", если окно еще не создавалось
+    if pygame.get_init():
+        return
+
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+    pygame.mixer.pre_init()
+    pygame.init()
+
+
+fonts = {}
+
+
+def load_font(spec):
+    # Шрифт по описанию (файл, размер), загружается один раз
+    font = fonts.get(spec)
+
+    if font is None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+
+        font = fonts[spec] = pygame.font.Font(*spec)
+
+    return font
+
+
+def merge_rects(rects):
+    # Объединение пересекающихся прямоугольников, результат не пересекается
+    merged = []
+
+    for r in rects:
+        r = pygame.Rect(r)
+        i = r.collidelist(merged)
+
+        while i != -1:
+            r.union_ip(merged.pop(i))
+            i = r.collidelist(merged)
+
+        merged.append(r)
+
+    return merged
+
+
+class TextCache():
+    # LRU-кеш отрендеренного текста по ключу (шрифт, текст, цвет).
+    # Числа собираются из атласа цифр, отрендеренного один раз на шрифт и цвет.
+
+    def __init__(self, size=TEXT_CACHE_SIZE):
+        self.size = size
+        self.surfaces = OrderedDict()
+        self.atlases = {}
+
+    def get(self, key, build):
+        surface = self.surfaces.get(key)
+
+        if surface is None:
+            surface = self.surfaces[key] = build()
+
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+
+        return surface
+
+    def render(self, font, text, color):
+        # Текст целиком
+        return self.get((font, text, color), lambda: load_font(font).render(text, 1, color))
+
+    def digits(self, font, color):
+        # Атлас цифр: все цифры на одной поверхности и их прямоугольники в ней
+        key = (font, color)
+
+        if key not in self.atlases:
+            glyphs = [load_font(font).render(d, 1, color) for d in "0123456789"]
+            atlas = pygame.Surface((sum(g.get_width() for g in glyphs), load_font(font).get_height()), pygame.SRCALPHA, 32)
+            rects = {}
+            x = 0
+
+            for d, g in zip("0123456789", glyphs):
+                rects[d] = atlas.blit(g, (x, 0))
+                x += g.get_width()
+
+            self.atlases[key] = (atlas, rects)
+
+        return self.atlases[key]
+
+    def number(self, font, label, value, color):
+        # Подпись с числом ("Score: 15"): подпись берется из кеша, цифры - из атласа,
+        # новая поверхность собирается только при изменении значения.
+        # Цифры ставятся по ширине строки до них (font.size с учетом кернинга), поэтому
+        # размер и положение цифр те же, что у font.render всей строки; сами глифы могут
+        # отличаться от него сглаживанием (дробные отступы внутри пикселя).
+        text = str(value)
+
+        if not text.isdigit():
+            return self.render(font, label + text, color)
+
+        def build():
+            f = load_font(font)
+            label_surface = self.render(font, label, color)
+            atlas, rects = self.digits(font, color)
+            width, height = f.size(label + text)
+            surface = pygame.Surface((width, max(height, label_surface.get_height(), atlas.get_height())), pygame.SRCALPHA, 32)
+            surface.blit(label_surface, (0, 0))
+
+            for i, d in enumerate(text):
+                surface.blit(atlas, (f.size(label + text[:i])[0], 0), rects[d])
+
+            return surface
+
+        return self.get((font, label, value, color), build)
+
+
+text_cache = TextCache()
+
+
+class Atlas():
+    # Атлас спрайтов: изображения копируются на общие страницы ATLAS_SIZE x ATLAS_SIZE
+    # (укладка полками по высоте), объекты получают подповерхности страниц.
+
+    def __init__(self, size=ATLAS_SIZE):
+        self.size = size
+        self.pages = []
+        self.x = self.y = self.shelf = 0
+
+    def fits(self, img):
+        return img.get_width() <= self.size and img.get_height() <= self.size
+
+    def add(self, img):
+        w, h = img.get_size()
+
+        # Новая полка, если изображение не помещается в текущую
+        if self.x + w > self.size:
+            self.x, self.y, self.shelf = 0, self.y + self.shelf, 0
+
+        # Новая страница, если не помещается по высоте
+        if not self.pages or self.y + h > self.size:
+            page = pygame.Surface((self.size, self.size), pygame.SRCALPHA, 32)
+            self.pages.append(page.convert_alpha() if pygame.display.get_surface() is not None else page)
+            self.x = self.y = self.shelf = 0
+
+        page = self.pages[-1]
+        rect = pygame.Rect(self.x, self.y, w, h)
+        page.blit(img, rect)
+
+        self.x += w
+        self.shelf = max(self.shelf, h)
+
+        return page.subsurface(rect)
+
+
+class Assets():
+    # Общий кеш изображений. Изображение загружается при первом обращении,
+    # конвертируется в формат экрана один раз и хранится по ключу (путь, размер, отражение),
+    # так что все объекты используют одни и те же поверхности. До создания окна
+    # конвертировать не во что, поэтому такие изображения не кешируются.
+
+    def __init__(self):
+        self.images = {}
+        self.hits = 0
+        self.misses = 0
+        self.atlas = Atlas()
+
+    def prepare(self, img, rle, converted=False):
+        # Приведение к формату экрана: непрозрачные изображения - без альфа-канала,
+        # с прозрачностью - с альфа-каналом и RLE (или в атлас, если включен).
+        # rle=False - для изображений, которые рисуются на прозрачные чанки слоев:
+        # SDL смешивает RLE-изображения так, будто под ними непрозрачный фон.
+        # converted=True - img уже в формате экрана (отражение готового изображения).
+        if pygame.display.get_surface() is None:
+            return img
+
+        if not rle:
+            return img if converted else img.convert_alpha()
+
+        if pygame.mask.from_surface(img, 254).count() == img.get_width() * img.get_height():
+            return img if converted else img.convert()
+
+        if not converted:
+            img = img.convert_alpha()
+
+        if SPRITE_ATLAS and self.atlas.fits(img):
+            return self.atlas.add(img)
+
+        if SPRITE_RLE:
+            img.set_alpha(255, pygame.RLEACCEL)
+
+        return img
+
+    def image(self, file_path, size=(GRID_SIZE, GRID_SIZE), flip=False, rle=True):
+        # size=None - исходный размер, flip=True - отражение по горизонтали
+        key = (file_path, size, flip, rle)
+        img = self.images.get(key)
+
+        if img is not None:
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        display = pygame.display.get_surface() is not None
+
+        if flip:
+            # Отражение готового изображения уже в формате экрана
+            img = self.prepare(pygame.transform.flip(self.image(file_path, size, rle=rle), 1, 0), rle, display)
+        else:
+            img = pygame.image.load(file_path)
+
+            if size is not None:
+                img = pygame.transform.scale(img, size)
+
+            img = self.prepare(img, rle)
+
+        if display:
+            self.images[key] = img
+
+        return img
+
+    def stats(self):
+        # Статистика кеша: попадания, промахи, доля попаданий и занятая память
+        total = self.hits + self.misses
+
+        return {"images": len(self.images),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "atlas_pages": len(self.atlas.pages),
+                "bytes": sum(img.get_pitch() * img.get_height() for img in self.images.values()
+                             if img.get_parent() is None) +
+                         sum(page.get_pitch() * page.get_height() for page in self.atlas.pages)}
+
+
+assets = Assets()
+
+
+class SoundBank():
+    # Звуковые эффекты и музыка. Эффекты загружаются и декодируются заранее (preload),
+    # при подготовке уровня; play() только запускает готовый звук на одном из каналов.
+    # Если свободных каналов нет, новый звук вытесняет самый старый звук
+    # с приоритетом не выше своего. Без микшера или без файлов звуки пропускаются.
+
+    def __init__(self, channels=SOUND_CHANNELS):
+        self.count = channels
+        self.sounds = {}
+        self.missing = set()
+        self.channels = []
+
+        # Что играет на каждом канале: (приоритет, номер запуска)
+        self.playing = []
+        self.started = 0
+        self.music = None
+
+    def available(self):
+        return pygame.mixer.get_init() is not None
+
+    def preload(self, effects):
+        # effects - {имя: (файл, приоритет)}, уже загруженные и отсутствующие файлы пропускаются
+        if not self.available():
+            return
+
+        if not self.channels:
+            pygame.mixer.set_num_channels(self.count)
+            self.channels = [pygame.mixer.Channel(i) for i in range(self.count)]
+            self.playing = [(0, 0)] * self.count
+
+        for name, (path, priority) in effects.items():
+            if name in self.sounds or path in self.missing:
+                continue
+
+            try:
+                sound = pygame.mixer.Sound(path)
+            except (pygame.error, OSError):
+                self.missing.add(path)
+                continue
+
+            sound.set_volume(SOUND_VOLUME)
+            self.sounds[name] = (sound, priority)
+
+    def play(self, name):
+        # Запуск эффекта; возвращает канал или None, если звук не прозвучал
+        entry = self.sounds.get(name)
+
+        if entry is None:
+            return None
+
+        sound, priority = entry
+        victim = None
+
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                victim = i
+                break
+
+            p, n = self.playing[i]
+
+            if p <= priority and (victim is None or n < self.playing[victim][1]):
+                victim = i
+
+        if victim is None:
+            return None
+
+        self.started += 1
+        self.playing[victim] = (priority, self.started)
+        self.channels[victim].play(sound)
+
+        return self.channels[victim]
+
+    def play_music(self, path):
+        # Музыка уровня читается с диска по частям (mixer.music); та же музыка не перезапускается
+        if not self.available() or not path:
+            return
+
+        if path == self.music and pygame.mixer.music.get_busy():
+            return
+
+        try:
+            pygame.mixer.music.load(path)
+            pygame.mixer.music.set_volume(MUSIC_VOLUME)
+            pygame.mixer.music.play(-1)
+            self.music = path
+        except (pygame.error, OSError):
+            self.music = None
+
+    def stop_music(self):
+        if self.available() and self.music is not None:
+            pygame.mixer.music.stop()
+
+        self.music = None
+
+
+sounds = SoundBank()
+
+# Время по фазам кадра и счетчики проверок столкновений
+frame_profiler = profiler.FrameProfiler()
+
+
+# Изображения (пути к файлам, загружаются через assets при первом использовании)
+hero_images = {"run": ["assets/character/adventurer_walk1.png",
+                       "assets/character/adventurer_walk2.png"],
+               "jump": "assets/character/adventurer_jump.png",
+               "idle": "assets/character/adventurer_idle.png"}
+
+block_images = {"TL": "assets/tiles/top_left.png",
+                "TM": "assets/tiles/top_middle.png",
+                "TR": "assets/tiles/top_right.png",
+                "ER": "assets/tiles/end_right.png",
+                "EL": "assets/tiles/end_left.png",
+                "TP": "assets/tiles/top.png",
+                "CN": "assets/tiles/center.png",
+                "LF": "assets/tiles/lone_float.png",
+                "SP": "assets/tiles/special.png"}
+
+# Коды тайлов в сетке уровня (0 - пустая ячейка)
+TILE_CODES = ["TL", "TM", "TR", "ER", "EL", "TP", "CN", "LF", "SP"]
+
+coin_img = "assets/items/coin.png"
+heart_img = "assets/items/bandaid.png"
+oneup_img = "assets/items/first_aid.png"
+flag_img = "assets/items/flag.png"
+flagpole_img = "assets/items/flagpole.png"
+
+monster_images = ["assets/enemies/monster-1.png",
+                  "assets/enemies/monster-2.png"]
+
+bear_images = ["assets/enemies/bear-1.png"]
+
+# Звуковые эффекты: имя -> (файл, приоритет при нехватке каналов). Файлов звуков
+# в репозитории нет, поэтому таблица пуста и игра идет без эффектов. Чтобы добавить звук,
+# положите файл (.ogg или .wav) в assets/sounds/ и запись с одним из имен, которые
+# запускает игра (jump, coin, powerup, hurt, flag), например:
+#
+#   sound_effects = {"jump": ("assets/sounds/jump.ogg", 1),
+#                    "hurt": ("assets/sounds/hurt.ogg", 2),
+#                    "flag": ("assets/sounds/level_complete.ogg", 3)}
+#
+# Эффекты без записи в таблице и файлы, которые не удалось загрузить, пропускаются
+# (SoundBank.missing). Музыка уровня - ключ "music" в файле уровня, по тем же правилам.
+sound_effects = {}
 
 
 class Entity(pygame.sprite.Sprite):
@@ -96,32 +512,27 @@ class Entity(pygame.sprite.Sprite):
         self.vy += level.gravity
         self.vy = min(self.vy, level.terminal_velocity)
 
-class Block(Entity):
-    # Класс блока в игре, наследуется от Entity.
-
-    def __init__(self, x, y, image):
-        # Инициализация блока
-        super().__init__(x, y, image)
-
-
 class Character(Entity):
     # Класс персонажа игры, наследуется от Entity.
 
     def __init__(self, images):
         # Инициализация персонажа
-        super().__init__(0, 0, images['idle'])
+        super().__init__(0, 0, assets.image(images['idle']))
 
-        self.image_idle_right = images['idle']
-        self.image_idle_left = pygame.transform.flip(self.image_idle_right, 1, 0)
-        self.images_run_right = images['run']
-        self.images_run_left = [pygame.transform.flip(img, 1, 0) for img in self.images_run_right]
-        self.image_jump_right = images['jump']
-        self.image_jump_left = pygame.transform.flip(self.image_jump_right, 1, 0)
+        self.image_idle_right = assets.image(images['idle'])
+        self.image_idle_left = assets.image(images['idle'], flip=True)
+        self.images_run_right = [assets.image(p) for p in images['run']]
+        self.images_run_left = [assets.image(p, flip=True) for p in images['run']]
+        self.image_jump_right = assets.image(images['jump'])
+        self.image_jump_left = assets.image(images['jump'], flip=True)
 
         self.running_images = self.images_run_right
         self.image_index = 0
         self.steps = 0
 
+        # Номер текущего кадра в all_images() (для снимков состояния)
+        self.frame = 0
+
         self.speed = 5
         self.jump_power = 20
 
@@ -150,15 +561,16 @@ class Character(Entity):
         # Остановка движения персонажа.
         self.vx = 0
 
-    def jump(self, blocks):
+    def jump(self, tiles):
         # Персонаж выполняет прыжок, проверяя столкновение с блоками.
         self.rect.y += 1
 
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = tiles.collide(self.rect)
 
         if len(hit_list) > 0:
             # Если есть столкновение с блоком, выполнить прыжок и воспроизвести звук
             self.vy = -1 * self.jump_power
+            sounds.play("jump")
 
         self.rect.y -= 1
 
@@ -169,59 +581,56 @@ class Character(Entity):
         elif self.rect.right > level.width:
             self.rect.right = level.width
 
-    def move_and_process_blocks(self, blocks):
+    def move_and_process_blocks(self, tiles):
         # Движение и обработка столкновений с блоками.
-        self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        # Лишний пиксель вниз оставлен: под него подобраны высота прыжка и уровни
+        nx, ny = tiles.sweep(self.rect, self.vx, self.vy + 1)
 
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.vx = 0
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.vx = 0
+        if nx != 0:
+            self.vx = 0
 
-        self.on_ground = False
-        self.rect.y += self.vy + 1
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        if ny != 0:
+            self.vy = 0
 
-        for block in hit_list:
-            if self.vy > 0:
-                self.rect.bottom = block.rect.top
-                self.vy = 0
-                self.on_ground = True
-            elif self.vy < 0:
-                self.rect.top = block.rect.bottom
-                self.vy = 0
+        self.on_ground = ny < 0
 
     def process_coins(self, coins):
         # Обработка сбора монет.
-        hit_list = pygame.sprite.spritecollide(self, coins, True)
+        hit_list = coins.collide(self, True)
 
         for coin in hit_list:
             self.score += coin.value
 
+        if hit_list:
+            sounds.play("coin")
+
     def process_enemies(self, enemies):
         # Обработка столкновения с врагами.
-        hit_list = pygame.sprite.spritecollide(self, enemies, False)
+        hit_list = enemies.collide(self, False)
 
         if len(hit_list) > 0 and self.invincibility == 0:
             self.hearts -= 1
             self.invincibility = int(0.75 * FPS)
+            sounds.play("hurt")
 
     def process_powerups(self, powerups):
         # Обработка подбора усилений.
-        hit_list = pygame.sprite.spritecollide(self, powerups, True)
+        hit_list = powerups.collide(self, True)
 
         for p in hit_list:
             p.apply(self)
 
+        if hit_list:
+            sounds.play("powerup")
+
     def check_flag(self, level):
         # Проверка столкновения с флагом.
-        hit_list = pygame.sprite.spritecollide(self, level.flag, False)
+        hit_list = level.flag_hash.collide(self, False)
 
         if len(hit_list) > 0:
+            if not level.completed:
+                sounds.play("flag")
+
             level.completed = True
 
     def set_image(self):
@@ -237,23 +646,56 @@ class Character(Entity):
 
                 if self.steps == 0:
                     self.image_index = (self.image_index + 1) % len(self.running_images)
-                    self.image = self.running_images[self.image_index]
+                    left = 0 if self.running_images is self.images_run_right else len(self.images_run_right)
+                    self.set_frame(4 + left + self.image_index)
             else:
                 if self.facing_right:
-                    self.image = self.image_idle_right
+                    self.set_frame(0)
                 else:
-                    self.image = self.image_idle_left
+                    self.set_frame(1)
         else:
             if self.facing_right:
-                self.image = self.image_jump_right
+                self.set_frame(2)
             else:
-                self.image = self.image_jump_left
+                self.set_frame(3)
 
     def die(self):
         # Обработка смерти персонажа.
         self.lives -= 1
 
 
+    # Все кадры персонажа (для сохранения текущего кадра по номеру)
+    def all_images(self):
+        return ([self.image_idle_right, self.image_idle_left, self.image_jump_right, self.image_jump_left] +
+                self.images_run_right + self.images_run_left)
+
+    def set_frame(self, frame):
+        # Текущий кадр по номеру в all_images()
+        self.frame = frame
+        self.image = self.all_images()[frame]
+
+    def snapshot(self):
+        # Состояние персонажа в компактном массиве
+        return array('d', [self.rect.x, self.rect.y, self.vx, self.vy,
+                           self.facing_right, self.on_ground, self.running_images is self.images_run_right,
+                           self.image_index, self.steps, self.frame,
+                           self.score, self.lives, self.hearts, self.invincibility])
+
+    def restore(self, state):
+        # Восстановление состояния из snapshot()
+        (x, y, vx, self.vy, facing_right, on_ground, running_right,
+         image_index, steps, frame, score, lives, hearts, invincibility) = state
+
+        # Горизонтальная скорость в игре всегда целая
+        self.rect.x, self.rect.y, self.vx = int(x), int(y), int(vx)
+        self.facing_right = bool(facing_right)
+        self.on_ground = bool(on_ground)
+        self.running_images = self.images_run_right if running_right else self.images_run_left
+        self.image_index, self.steps = int(image_index), int(steps)
+        self.set_frame(int(frame))
+        self.score, self.lives, self.hearts = int(score), int(lives), int(hearts)
+        self.invincibility = int(invincibility)
+
     def respawn(self, level):
         # Возрождение персонажа на стартовой позиции.
         self.rect.x = level.start_x
@@ -264,16 +706,22 @@ class Character(Entity):
 
     def update(self, level):
         # Обновление состояния персонажа на каждом кадре.
-        self.process_enemies(level.enemies)
+        with frame_profiler.phase("update.collision"):
+            self.process_enemies(level.enemy_hash)
+
         self.apply_gravity(level)
-        self.move_and_process_blocks(level.blocks)
+
+        with frame_profiler.phase("update.collision"):
+            self.move_and_process_blocks(level.tiles)
+
         self.check_world_boundaries(level)
         self.set_image()
 
         if self.hearts > 0:
-            self.process_coins(level.coins)
-            self.process_powerups(level.powerups)
-            self.check_flag(level)
+            with frame_profiler.phase("update.collision"):
+                self.process_coins(level.coin_hash)
+                self.process_powerups(level.powerup_hash)
+                self.check_flag(level)
 
             if self.invincibility > 0:
                 self.invincibility -= 1
@@ -294,16 +742,31 @@ class Coin(Entity):
 class Enemy(Entity):
     # Класс для представления врага, наследуется от Entity.
 
+    # Разворачивается ли враг на краю платформы
+    turns_at_ledges = False
+
     def __init__(self, x, y, images):
         # Инициализация врага
-        super().__init__(x, y, images[0])
+        super().__init__(x, y, assets.image(images[0]))
 
-        self.images_left = images
-        self.images_right = [pygame.transform.flip(img, 1, 0) for img in images]
+        # Кадры общие для всех врагов одного типа (из кеша assets)
+        self.images_left = [assets.image(p) for p in images]
+        self.images_right = [assets.image(p, flip=True) for p in images]
         self.current_images = self.images_left
         self.image_index = 0
         self.steps = 0
 
+        # Номер текущего кадра в current_images (для снимков состояния)
+        self.frame = 0
+
+        # Враг может стоять в клетке блока (так расставлены некоторые враги в уровнях):
+        # до первого шага вне блоков столкновения разрешаются прежним способом
+        self.embedded = True
+
+    def set_frame(self, frame):
+        self.frame = frame
+        self.image = self.current_images[frame]
+
     def reverse(self):
         # Изменение направления движения врага
         self.vx *= -1
@@ -313,7 +776,7 @@ class Enemy(Entity):
         else:
             self.current_images = self.images_right
 
-        self.image = self.current_images[self.image_index]
+        self.set_frame(self.image_index)
 
     def check_world_boundaries(self, level):
         # Проверка границ мира для врага
@@ -324,34 +787,52 @@ class Enemy(Entity):
             self.rect.right = level.width
             self.reverse()
 
-    def move_and_process_blocks(self, blocks):
-        # Движение и обработка столкновений с блоками
+    def move_and_process_blocks(self, tiles):
+        # Движение и обработка столкновений с блоками: у стены враг разворачивается
+        if self.embedded:
+            if tiles.collide(self.rect):
+                self.push_out(tiles)
+                return
+
+            self.embedded = False
+
+        nx, ny = tiles.sweep(self.rect, self.vx, self.vy)
+
+        if nx != 0:
+            self.reverse()
+
+        if ny != 0:
+            self.vy = 0
+
+    def push_out(self, tiles):
+        # Прежнее разрешение столкновений для врага внутри блоков: сдвиг по оси
+        # и упор в каждый пересеченный блок
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = tiles.collide(self.rect)
 
         for block in hit_list:
             if self.vx > 0:
-                self.rect.right = block.rect.left
+                self.rect.right = block.left
                 self.reverse()
             elif self.vx < 0:
-                self.rect.left = block.rect.right
+                self.rect.left = block.right
                 self.reverse()
 
-        self.rect.y += self.vy  # the +1 is hacky. not sure why it helps.
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        self.rect.y += self.vy
+        hit_list = tiles.collide(self.rect)
 
         for block in hit_list:
             if self.vy > 0:
-                self.rect.bottom = block.rect.top
+                self.rect.bottom = block.top
                 self.vy = 0
             elif self.vy < 0:
-                self.rect.top = block.rect.bottom
+                self.rect.top = block.bottom
                 self.vy = 0
 
     def set_images(self):
         # Установка изображения врага в зависимости от состояния
         if self.steps == 0:
-            self.image = self.current_images[self.image_index]
+            self.set_frame(self.image_index)
             self.image_index = (self.image_index + 1) % len(self.current_images)
 
         self.steps = (self.steps + 1) % 20  # Nothing significant about 20. It just seems to work okay.
@@ -364,9 +845,29 @@ class Enemy(Entity):
         # Обновление состояния врага на каждом кадре, если герой в пределах видимости
         if self.is_near(hero):
             self.apply_gravity(level)
-            self.move_and_process_blocks(level.blocks)
+
+            with frame_profiler.phase("update.collision"):
+                self.move_and_process_blocks(level.tiles)
+
             self.check_world_boundaries(level)
             self.set_images()
+            level.enemy_hash.move(self)
+
+    def snapshot(self):
+        # Состояние врага: ENEMY_STATE чисел (см. Level.snapshot)
+        return [self.rect.x, self.rect.y, self.vx, self.vy, self.image_index, self.steps,
+                self.current_images is self.images_right, self.frame]
+
+    def restore(self, state):
+        # Восстановление состояния из snapshot()
+        x, y, vx, self.vy, image_index, steps, right, frame = state
+
+        # Горизонтальная скорость в игре всегда целая
+        self.rect.x, self.rect.y, self.vx = int(x), int(y), int(vx)
+        self.image_index, self.steps = int(image_index), int(steps)
+        self.current_images = self.images_right if right else self.images_left
+        self.set_frame(int(frame))
+        self.embedded = True
 
     def reset(self):
         # Сброс в начальное состояние
@@ -375,8 +876,9 @@ class Enemy(Entity):
         self.vx = self.start_vx
         self.vy = self.start_vy
         self.current_images = self.images_left
-        self.image = self.current_images[0]
+        self.set_frame(0)
         self.steps = 0
+        self.embedded = True
 
 
 class Bear(Enemy):
@@ -397,6 +899,8 @@ class Bear(Enemy):
 class Monster(Enemy):
     # Класс для представления монстра, наследуется от Enemy
 
+    turns_at_ledges = True
+
     def __init__(self, x, y, images):
         super().__init__(x, y, images)
 
@@ -408,43 +912,69 @@ class Monster(Enemy):
         self.vx = self.start_vx
         self.vy = self.start_vy
 
-    def move_and_process_blocks(self, blocks):
-        # Дополнительная обработка столкновений для монстра
-        reverse = False
+        # Участок (начало, конец) в пикселях, по которому монстр ходит (см. TileMap.span_at);
+        # None - монстр в воздухе или участок еще не найден
+        self.span = None
+
+    def move_and_process_blocks(self, tiles):
+        # На участке столкновения не проверяются: монстр идет, пока его передний край
+        # над участком, и разворачивается у края или у стены
+        if self.span is None:
+            self.fall(tiles)
+            return
 
+        self.vy = 0
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
 
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.reverse()
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.reverse()
+        if self.rect.left < self.span[0] or self.rect.right > self.span[1]:
+            self.reach_edge(tiles)
 
-        self.rect.y += self.vy + 1  # the +1 is hacky. not sure why it helps.
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+    def front(self):
+        # Передний (по направлению движения) пиксель нижней грани
+        return self.rect.right - 1 if self.vx > 0 else self.rect.left
 
-        reverse = True
+    def fall(self, tiles):
+        # В воздухе - обычные столкновения, после приземления монстр получает участок
+        super().move_and_process_blocks(tiles)
 
-        for block in hit_list:
-            if self.vy >= 0:
-                self.rect.bottom = block.rect.top
-                self.vy = 0
+        if self.vy != 0 or self.rect.bottom % tiles.size != 0:
+            return
 
-                if self.vx > 0 and self.rect.right <= block.rect.right:
-                    reverse = False
+        # Передний край над пустотой - разворот, участок найдется на следующем шаге
+        self.span = tiles.span_at(self.rect.bottom // tiles.size, self.front())
 
-                elif self.vx < 0 and self.rect.left >= block.rect.left:
-                    reverse = False
+        if self.span is None:
+            self.reverse()
 
-            elif self.vy < 0:
-                self.rect.top = block.rect.bottom
-                self.vy = 0
+    def reach_edge(self, tiles):
+        # Передний край вышел за участок: участок продолжается (соседний чанк загрузился),
+        # впереди стена или граница уровня - упор и разворот, иначе край - разворот
+        size = tiles.size
+        cy = self.rect.bottom // size
+        front = self.front()
+        span = tiles.span_at(cy, front)
 
-        if reverse:
-            self.reverse()
+        if span is not None:
+            self.span = span
+            return
+
+        cx = front // size
+
+        if not 0 <= cx < tiles.cols or tiles.code_at(cx, cy - 1) is not None:
+            if self.vx > 0:
+                self.rect.right = cx * size
+            else:
+                self.rect.left = (cx + 1) * size
+
+        self.reverse()
+
+    def restore(self, state):
+        super().restore(state)
+        self.span = None
+
+    def reset(self):
+        super().reset()
+        self.span = None
 
 
 class OneUp(Entity):
@@ -479,206 +1009,1390 @@ class Flag(Entity):
         # Инициализация флага
         super().__init__(x, y, image)
 
-# Определение класса Level
-class Level():
+# Ячейки сетки: 0 - пусто, 1 - блок (для построения участков ходьбы)
+SOLID_TABLE = bytes([0] + [1] * 255)
+WALKABLE_RUN = re.compile(b"\x01+")
+
+
+class TileMap():
+    # Статические блоки уровня в виде сетки: коды тайлов хранятся в плоском
+    # массиве, ячейка (cx, cy) = (x // GRID_SIZE, y // GRID_SIZE).
+
+    def __init__(self, cols, rows, size=GRID_SIZE):
+        self.cols = cols
+        self.rows = rows
+        self.size = size
+
+        # 0 - пустая ячейка, иначе индекс кода в TILE_CODES + 1
+        self.tiles = bytearray(cols * rows)
+
+        # Порядок добавления блоков, чтобы столкновения обрабатывались
+        # в том же порядке, что и раньше со спрайтами
+        self.order = array('I', [0]) * (cols * rows)
+        self.count = 0
 
-    # Конструктор класса, инициализация атрибутов объекта
-    def __init__(self, file_path):
-        # Списки для хранения начальных объектов различных типов
-        self.starting_blocks = []
-        self.starting_enemies = []
-        self.starting_coins = []
-        self.starting_powerups = []
-        self.starting_flag = []
+        # Участки для ходьбы (см. build_spans), строятся при первом обращении
+        self.span_starts = None
 
-        # Группы спрайтов для разных типов объектов
-        self.blocks = pygame.sprite.Group()
-        self.enemies = pygame.sprite.Group()
-        self.coins = pygame.sprite.Group()
-        self.powerups = pygame.sprite.Group()
-        self.flag = pygame.sprite.Group()
+    @classmethod
+    def from_grid(cls, grid):
+        # Сетка из готовых массивов (см. level_cache.build_grid).
+        # Коды уровня переводятся в индексы TILE_CODES.
+        cols, rows, codes, tiles, order = grid
+        table = bytes([0] + [TILE_CODES.index(code) + 1 for code in codes]).ljust(256, b"\0")
 
-        # Группы для активных и неактивных спрайтов
-        self.active_sprites = pygame.sprite.Group()
-        self.inactive_sprites = pygame.sprite.Group()
+        tilemap = cls.__new__(cls)
+        tilemap.cols = cols
+        tilemap.rows = rows
+        tilemap.size = GRID_SIZE
+        tilemap.tiles = bytearray(tiles).translate(table)
+        tilemap.order = order
+        tilemap.count = len(tilemap.tiles) - tilemap.tiles.count(0)
+        tilemap.build_spans()
 
-        # Загрузка данных из файла
-        with open(file_path, 'r') as f:
-            data = f.read()
+        return tilemap
+
+    def add(self, cx, cy, code):
+        # Добавление блока в ячейку сетки
+        if not (0 <= cx < self.cols and 0 <= cy < self.rows):
+            raise ValueError("block (%d, %d) is outside the level grid" % (cx, cy))
+
+        i = cy * self.cols + cx
+        self.tiles[i] = TILE_CODES.index(code) + 1
+        self.order[i] = self.count
+        self.count += 1
+        self.span_starts = None
+
+    def build_spans(self):
+        # Участки, по которым можно ходить: для каждой строки сетки - отсортированные
+        # интервалы [начало, конец) в пикселях из подряд идущих блоков, над которыми пусто
+        cols, size = self.cols, self.size
+        solid = self.tiles.translate(SOLID_TABLE)
+        above = 0
+        self.span_starts = []
+        self.span_ends = []
+
+        for cy in range(self.rows):
+            row = int.from_bytes(solid[cy * cols:(cy + 1) * cols], "big")
+            walkable = (row & ~above).to_bytes(cols, "big")
+            runs = [m.span() for m in WALKABLE_RUN.finditer(walkable)]
+
+            self.span_starts.append([a * size for a, b in runs])
+            self.span_ends.append([b * size for a, b in runs])
+            above = row
+
+    def span_at(self, cy, x):
+        # Участок строки cy (блоки, на которых стоят), содержащий пиксель x, или None
+        if self.span_starts is None:
+            self.build_spans()
+
+        if not 0 <= cy < self.rows:
+            return None
+
+        starts = self.span_starts[cy]
+        i = bisect_right(starts, x) - 1
+
+        if i >= 0 and x < self.span_ends[cy][i]:
+            return starts[i], self.span_ends[cy][i]
+
+        return None
+
+    def code_at(self, cx, cy):
+        # Код тайла в ячейке или None, если ячейка пуста
+        if 0 <= cx < self.cols and 0 <= cy < self.rows:
+            t = self.tiles[cy * self.cols + cx]
+
+            if t:
+                return TILE_CODES[t - 1]
+
+        return None
+
+    def collide(self, rect):
+        # Прямоугольники блоков, с которыми пересекается rect.
+        # Проверяются только ячейки, которые перекрывает rect.
+        if rect.width <= 0 or rect.height <= 0:
+            return []
+
+        size = self.size
+        x0 = max(rect.left // size, 0)
+        x1 = min((rect.right - 1) // size, self.cols - 1)
+        y0 = max(rect.top // size, 0)
+        y1 = min((rect.bottom - 1) // size, self.rows - 1)
+
+        frame_profiler.count("tile_queries")
+        frame_profiler.count("tiles_tested", max(x1 - x0 + 1, 0) * max(y1 - y0 + 1, 0))
+
+        hits = []
+
+        for cy in range(y0, y1 + 1):
+            row = cy * self.cols
+
+            for cx in range(x0, x1 + 1):
+                if self.tiles[row + cx]:
+                    hits.append((self.order[row + cx], cx, cy))
+
+        if len(hits) > 1:
+            hits.sort()
+
+        return [pygame.Rect(cx * size, cy * size, size, size) for _, cx, cy in hits]
+
+    def column_blocked(self, cx, y0, y1):
+        # Есть ли блок в столбце cx в строках y0..y1
+        return any(self.tiles[y0 * self.cols + cx:y1 * self.cols + cx + 1:self.cols])
+
+    def row_blocked(self, cy, x0, x1):
+        # Есть ли блок в строке cy в столбцах x0..x1
+        return any(self.tiles[cy * self.cols + x0:cy * self.cols + x1 + 1])
+
+    def sweep(self, rect, dx, dy):
+        # Перемещение rect на (dx, dy) с остановкой вплотную к блокам: сначала по x, потом по y.
+        # Возвращает нормали контакта (nx, ny): 0 - блока на пути нет, -1 или 1 - rect
+        # уперся в блок (ny == -1 - стоит на блоке, ny == 1 - ударился головой)
+        return self.sweep_axis(rect, 0, dx), self.sweep_axis(rect, 1, dy)
+
+    def sweep_axis(self, rect, axis, d):
+        # Движение по одной оси за один проход: столбцы (строки) на пути проверяются
+        # по порядку, первый с блоком дает момент столкновения. Промежуточные клетки
+        # тоже проверяются, поэтому rect не проскакивает сквозь блоки при любой скорости.
+        size = self.size
+
+        if axis == 0:
+            start, length, lo, hi = rect.x, rect.width, rect.top, rect.bottom
+            rect.x += d
+            d = rect.x - start
+            count, across, blocked = self.cols, self.rows, self.column_blocked
+        else:
+            start, length, lo, hi = rect.y, rect.height, rect.left, rect.right
+            rect.y += d
+            d = rect.y - start
+            count, across, blocked = self.rows, self.cols, self.row_blocked
+
+        # Клетки поперек движения, которые перекрывает rect
+        a0 = max(lo // size, 0)
+        a1 = min((hi - 1) // size, across - 1)
+
+        if d == 0 or a0 > a1:
+            return 0
+
+        # Первая линия - та, в которой лежит передний край (если rect уже зашел в блок,
+        # он выталкивается назад, как раньше), последняя - та, куда край придет
+        if d > 0:
+            lines = range(max((start + length) // size, 0), min((start + length + d - 1) // size, count - 1) + 1)
+        else:
+            lines = range(min((start - 1) // size, count - 1), max((start + d) // size, 0) - 1, -1)
 
-        map_data = json.loads(data)
+        frame_profiler.count("tile_queries")
+        frame_profiler.count("tiles_tested", len(lines) * (a1 - a0 + 1))
 
-        # Инициализация размеров уровня и начальной позиции игрока
-        self.width = map_data['width'] * GRID_SIZE
-        self.height = map_data['height'] * GRID_SIZE
-        self.start_x = map_data['start'][0] * GRID_SIZE
-        self.start_y = map_data['start'][1] * GRID_SIZE
+        for i in lines:
+            if blocked(i, a0, a1):
+                stop = i * size - length if d > 0 else (i + 1) * size
 
-        # Создание начальных объектов для разных типов
-        for item in map_data['blocks']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            img = block_images[item[2]]
-            self.starting_blocks.append(Block(x, y, img))
+                if axis == 0:
+                    rect.x = stop
+                else:
+                    rect.y = stop
 
-        for item in map_data['bears']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Bear(x, y, bear_images))
+                return -1 if d > 0 else 1
 
-        for item in map_data['monsters']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Monster(x, y, monster_images))
+        return 0
 
-        for item in map_data['coins']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_coins.append(Coin(x, y, coin_img))
+    def draw(self, surface, area):
+        # Отрисовка блоков, попадающих в area (координаты уровня),
+        # на поверхность, левый верхний угол которой соответствует area.topleft
+        size = self.size
+        images = [assets.image(block_images[code], rle=False) for code in TILE_CODES]
+        x0 = max(area.left // size, 0)
+        x1 = min((area.right - 1) // size, self.cols - 1)
+        y0 = max(area.top // size, 0)
+        y1 = min((area.bottom - 1) // size, self.rows - 1)
 
-        for item in map_data['oneups']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(OneUp(x, y, oneup_img))
+        for cy in range(y0, y1 + 1):
+            row = cy * self.cols
 
-        for item in map_data['hearts']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(Heart(x, y, heart_img))
+            for cx in range(x0, x1 + 1):
+                t = self.tiles[row + cx]
 
-        for i, item in enumerate(map_data['flag']):
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+                if t:
+                    surface.blit(images[t - 1], [cx * size - area.x, cy * size - area.y])
 
-            if i == 0:
-                img = flag_img
-            else:
-                img = flagpole_img
 
-            self.starting_flag.append(Flag(x, y, img))
+class StreamedTileMap():
+    # Сетка блоков потокового уровня: загруженные чанки хранятся как отдельные
+    # TileMap по chunk_cols столбцов, незагруженные столбцы считаются пустыми.
 
+    def __init__(self, cols, rows, chunk_cols, size=GRID_SIZE):
+        self.cols = cols
+        self.rows = rows
+        self.chunk_cols = chunk_cols
+        self.size = size
+        self.chunks = {}
 
-        # Инициализация слоев для отображения уровня
-        self.background_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.scenery_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.inactive_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.active_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
+    def code_at(self, cx, cy):
+        k = cx // self.chunk_cols
+        tilemap = self.chunks.get(k)
 
-        # Установка цвета фона и изображения заднего плана
-        if map_data['background-color'] != "":
-            self.background_layer.fill(map_data['background-color'])
+        return tilemap.code_at(cx - k * self.chunk_cols, cy) if tilemap is not None else None
 
-        if map_data['background-img'] != "":
-            background_img = pygame.image.load(map_data['background-img']).convert_alpha()
-            # Обработка и позиционирование изображения заднего фона
-            if map_data['background-fill-y']:
-                h = background_img.get_height()
-                w = int(background_img.get_width() * HEIGHT / h)
-                background_img = pygame.transform.scale(background_img, (w, HEIGHT))
+    def collide(self, rect):
+        # Прямоугольники блоков, с которыми пересекается rect (как TileMap.collide)
+        if rect.width <= 0 or rect.height <= 0:
+            return []
 
-            if "top" in map_data['background-position']:
-                start_y = 0
-            elif "bottom" in map_data['background-position']:
-                start_y = self.height - background_img.get_height()
+        size = self.size
+        x0 = max(rect.left // size, 0)
+        x1 = min((rect.right - 1) // size, self.cols - 1)
+        y0 = max(rect.top // size, 0)
+        y1 = min((rect.bottom - 1) // size, self.rows - 1)
 
-            if map_data['background-repeat-x']:
-                for x in range(0, self.width, background_img.get_width()):
-                    self.background_layer.blit(background_img, [x, start_y])
-            else:
-                self.background_layer.blit(background_img, [0, start_y])
-
-        # Загрузка изображения для слоя сцены (scenery)
-        if map_data['scenery-img'] != "":
-            scenery_img = pygame.image.load(map_data['scenery-img']).convert_alpha()
-            # Обработка и позиционирование изображения сцены
-            if map_data['scenery-fill-y']:
-                h = scenery_img.get_height()
-                w = int(scenery_img.get_width() * HEIGHT / h)
-                scenery_img = pygame.transform.scale(scenery_img, (w, HEIGHT))
-
-            if "top" in map_data['scenery-position']:
-                start_y = 0
-            elif "bottom" in map_data['scenery-position']:
-                start_y = self.height - scenery_img.get_height()
+        frame_profiler.count("tile_queries")
+        frame_profiler.count("tiles_tested", max(x1 - x0 + 1, 0) * max(y1 - y0 + 1, 0))
 
-            if map_data['scenery-repeat-x']:
-                for x in range(0, self.width, scenery_img.get_width()):
-                    self.scenery_layer.blit(scenery_img, [x, start_y])
-            else:
-                self.scenery_layer.blit(scenery_img, [0, start_y])
+        hits = []
 
+        for cx in range(x0, x1 + 1):
+            k = cx // self.chunk_cols
+            tilemap = self.chunks.get(k)
 
-        # Инициализация физических параметров уровня
-        self.gravity = map_data['gravity']
-        self.terminal_velocity = map_data['terminal-velocity']
+            if tilemap is None:
+                continue
 
-        # Флаг для отслеживания завершения уровня
-        self.completed = False
+            for cy in range(y0, y1 + 1):
+                i = cy * tilemap.cols + cx - k * self.chunk_cols
 
-        # Добавление начальных объектов в соответствующие группы
-        self.blocks.add(self.starting_blocks)
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.powerups.add(self.starting_powerups)
-        self.flag.add(self.starting_flag)
+                if tilemap.tiles[i]:
+                    hits.append((tilemap.order[i], cx, cy))
 
-        # Добавление групп в группы активных и неактивных спрайтов
-        self.active_sprites.add(self.coins, self.enemies, self.powerups)
-        self.inactive_sprites.add(self.blocks, self.flag)
+        if len(hits) > 1:
+            hits.sort()
 
-        # Оптимизация конвертации изображений для ускорения отрисовки
-        for s in self.active_sprites:
-            s.image.convert()
+        return [pygame.Rect(cx * size, cy * size, size, size) for _, cx, cy in hits]
 
-        for s in self.inactive_sprites:
-            s.image.convert()
+    def span_at(self, cy, x):
+        # Участок для ходьбы (как TileMap.span_at); участки на границе чанка
+        # продолжаются в соседних загруженных чанках
+        width = self.chunk_cols * self.size
+        k = x // width
+        tilemap = self.chunks.get(k)
+        span = tilemap.span_at(cy, x - k * width) if tilemap is not None else None
 
-        # Отрисовка неактивных спрайтов на неактивном слое
-        self.inactive_sprites.draw(self.inactive_layer)
+        if span is None:
+            return None
 
-        # Конвертация изображений для всех слоев (возможно, для оптимизации)
-        self.background_layer.convert()
-        self.scenery_layer.convert()
-        self.inactive_layer.convert()
-        self.active_layer.convert()
+        start, end = span[0] + k * width, span[1] + k * width
+        j = k
 
-    # Метод для сброса уровня
-    def reset(self):
-        # Добавление начальных врагов, монет и бонусов
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.powerups.add(self.starting_powerups)
+        while end == (j + 1) * width and j + 1 in self.chunks:
+            j += 1
+            span = self.chunks[j].span_at(cy, 0)
 
-        # Добавление объектов в активные спрайты
-        self.active_sprites.add(self.coins, self.enemies, self.powerups)
+            if span is None:
+                break
 
-        # Сброс состояния каждого врага
-        for e in self.enemies:
-            e.reset()
+            end = j * width + span[1]
 
+        j = k
 
-# Определение класса Game
-class Game():
+        while start == j * width and j - 1 in self.chunks:
+            j -= 1
+            span = self.chunks[j].span_at(cy, width - 1)
 
-    # Константы для состояний игры
-    SPLASH = 0
-    START = 1
-    PLAYING = 2
-    PAUSED = 3
-    LEVEL_COMPLETED = 4
-    GAME_OVER = 5
-    VICTORY = 6
+            if span is None:
+                break
+
+            start = j * width + span[0]
+
+        return start, end
+
+    def column_blocked(self, cx, y0, y1):
+        k = cx // self.chunk_cols
+        tilemap = self.chunks.get(k)
+
+        return tilemap is not None and tilemap.column_blocked(cx - k * self.chunk_cols, y0, y1)
+
+    def row_blocked(self, cy, x0, x1):
+        # Строка может проходить через несколько чанков
+        for k in range(x0 // self.chunk_cols, x1 // self.chunk_cols + 1):
+            tilemap = self.chunks.get(k)
+            offset = k * self.chunk_cols
+
+            if tilemap is not None and tilemap.row_blocked(cy, max(x0 - offset, 0), min(x1 - offset, tilemap.cols - 1)):
+                return True
+
+        return False
+
+    # Движение с остановкой у блоков - тот же алгоритм, что и у TileMap
+    sweep = TileMap.sweep
+    sweep_axis = TileMap.sweep_axis
+
+    def draw(self, surface, area):
+        # Отрисовка загруженных блоков, попадающих в area (как TileMap.draw)
+        width = self.chunk_cols * self.size
+
+        for k, tilemap in self.chunks.items():
+            if k * width < area.right and (k + 1) * width > area.left:
+                tilemap.draw(surface, area.move(-k * width, 0))
+
+
+class SpatialHash():
+    # Пространственный хеш для динамических объектов: спрайт хранится во всех
+    # ячейках, которые перекрывает его rect, запрос проверяет только их.
+
+    def __init__(self, cell_size=2 * GRID_SIZE):
+        self.cell_size = cell_size
+        self.buckets = {}
+
+        # Текущий диапазон ячеек каждого спрайта (x0, y0, x1, y1)
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, sprite):
+        return sprite in self.cells
+
+    def cell_range(self, rect):
+        # Диапазон ячеек, которые перекрывает прямоугольник
+        s = self.cell_size
+        return (rect.left // s, rect.top // s, (rect.right - 1) // s, (rect.bottom - 1) // s)
+
+    def add(self, sprite):
+        # Добавление спрайта в ячейки
+        if sprite in self.cells:
+            return
+
+        x0, y0, x1, y1 = self.cells[sprite] = self.cell_range(sprite.rect)
+
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                self.buckets.setdefault((cx, cy), {})[sprite] = None
+
+    def remove(self, sprite):
+        # Удаление спрайта из всех его ячеек
+        cells = self.cells.pop(sprite, None)
+
+        if cells is None:
+            return
+
+        x0, y0, x1, y1 = cells
+
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = self.buckets[(cx, cy)]
+                del bucket[sprite]
+
+                if not bucket:
+                    del self.buckets[(cx, cy)]
+
+    def move(self, sprite):
+        # Перераспределение спрайта после движения (только если сменились ячейки)
+        if self.cells.get(sprite) != self.cell_range(sprite.rect):
+            self.remove(sprite)
+            self.add(sprite)
+
+    def clear(self):
+        self.buckets.clear()
+        self.cells.clear()
+
+    def query(self, rect):
+        # Спрайты из ячеек, которые перекрывает rect (без точной проверки)
+        x0, y0, x1, y1 = self.cell_range(rect)
+        found = {}
+
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = self.buckets.get((cx, cy))
+
+                if bucket:
+                    found.update(bucket)
+
+        return list(found)
+
+    def collide(self, sprite, dokill):
+        # Аналог pygame.sprite.spritecollide, но только по соседним ячейкам
+        candidates = self.query(sprite.rect)
+        hit_list = [s for s in candidates if sprite.rect.colliderect(s.rect)]
+
+        frame_profiler.count("spritecollide")
+        frame_profiler.count("sprites_tested", len(candidates))
+
+        if dokill:
+            for s in hit_list:
+                s.kill()
+                self.remove(s)
+
+        return hit_list
+
+
+class ActivityIndex():
+    # Враги, разложенные по колонкам уровня шириной bucket_width. На каждом кадре
+    # просматриваются только колонки в окне radius вокруг героя: враги переходят
+    # из спящих в активные и обратно, когда окно сдвигается, а далекие враги
+    # не стоят ничего.
+
+    def __init__(self, radius, bucket_width=4 * GRID_SIZE):
+        self.radius = radius
+        self.bucket_width = bucket_width
+        self.columns = {}
+        self.column_of = {}
+        self.awake = {}
+        self.window = None
+
+    def in_window(self, col):
+        return self.window is not None and self.window[0] <= col <= self.window[1]
+
+    def move(self, item, x):
+        # Добавление или перенос объекта в колонку по координате x
+        col = x // self.bucket_width
+        old = self.column_of.get(item)
+
+        if old == col:
+            return
+
+        if old is not None:
+            column = self.columns[old]
+            del column[item]
+
+            if not column:
+                del self.columns[old]
+
+        self.columns.setdefault(col, {})[item] = None
+        self.column_of[item] = col
+
+        if self.in_window(col):
+            self.awake[item] = None
+        else:
+            self.awake.pop(item, None)
+
+    def remove(self, item):
+        # Удаление объекта из индекса
+        col = self.column_of.pop(item, None)
+
+        if col is not None:
+            column = self.columns[col]
+            del column[item]
+
+            if not column:
+                del self.columns[col]
+
+        self.awake.pop(item, None)
+
+    def update(self, x):
+        # Активные объекты для героя в точке x; при сдвиге окна просматриваются
+        # только колонки, которые вошли в окно или вышли из него
+        window = ((x - self.radius) // self.bucket_width, (x + self.radius) // self.bucket_width)
+
+        if window != self.window:
+            old = set(range(self.window[0], self.window[1] + 1)) if self.window else set()
+            new = set(range(window[0], window[1] + 1))
+
+            for col in old - new:
+                for item in self.columns.get(col, ()):
+                    self.awake.pop(item, None)
+
+            for col in new - old:
+                for item in self.columns.get(col, ()):
+                    self.awake[item] = None
+
+            self.window = window
+
+        return list(self.awake)
+
+
+class ChunkCache():
+    # Общий LRU-кеш чанков слоев уровня с ограничением по памяти (в байтах).
+    # Чанки, использованные в текущем кадре, не вытесняются.
+    # lock защищает кеш и построение чанков, если отрисовка идет в отдельном потоке.
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.chunks = OrderedDict()
+        self.bytes = 0
+        self.pinned = set()
+        self.lock = threading.RLock()
+
+    def begin_frame(self):
+        with self.lock:
+            self.pinned.clear()
+
+    def get(self, key, build):
+        # Чанк по ключу; если его нет - построение через build()
+        with self.lock:
+            surface = self.chunks.get(key)
+
+            if surface is None:
+                surface = build()
+                self.chunks[key] = surface
+                self.bytes += surface.get_pitch() * surface.get_height()
+            else:
+                self.chunks.move_to_end(key)
+
+            self.pinned.add(key)
+            self.evict()
+
+        return surface
+
+    def __contains__(self, key):
+        return key in self.chunks
+
+    def peek(self, key):
+        # Чанк по ключу без построения и без отметки об использовании (None, если его нет)
+        return self.chunks.get(key)
+
+    def discard(self, key):
+        # Удаление устаревшего чанка
+        with self.lock:
+            surface = self.chunks.pop(key, None)
+
+            if surface is not None:
+                self.bytes -= surface.get_pitch() * surface.get_height()
+
+    def evict(self):
+        # Удаление давно не использованных чанков при превышении бюджета
+        while self.bytes > self.budget and self.chunks:
+            key = next(iter(self.chunks))
+
+            if key in self.pinned:
+                break
+
+            surface = self.chunks.pop(key)
+            self.bytes -= surface.get_pitch() * surface.get_height()
+
+
+class ChunkedLayer():
+    # Слой уровня, разбитый на чанки CHUNK_SIZE x CHUNK_SIZE.
+    # paint(surface, area) рисует фрагмент слоя area на поверхность чанка.
+
+    def __init__(self, width, height, paint, cache, chunk_size=CHUNK_SIZE):
+        self.width = width
+        self.height = height
+        self.paint = paint
+        self.cache = cache
+        self.chunk_size = chunk_size
+
+    def area(self, cx, cy):
+        # Прямоугольник чанка в координатах уровня
+        x, y = cx * self.chunk_size, cy * self.chunk_size
+        w = min(self.chunk_size, self.width - x)
+        h = min(self.chunk_size, self.height - y)
+
+        return pygame.Rect(x, y, w, h)
+
+    def build(self, cx, cy):
+        area = self.area(cx, cy)
+        surface = pygame.Surface(area.size, pygame.SRCALPHA, 32)
+        self.paint(surface, area)
+
+        # Чанк в основном прозрачный, RLE пропускает пустые участки при отрисовке
+        if SPRITE_RLE:
+            surface.set_alpha(255, pygame.RLEACCEL)
+
+        return surface
+
+    def chunk_range(self, rect):
+        # Диапазон чанков, пересекающих rect (в координатах уровня)
+        rect = rect.clip(pygame.Rect(0, 0, self.width, self.height))
+
+        if rect.width <= 0 or rect.height <= 0:
+            return range(0), range(0)
+
+        s = self.chunk_size
+
+        return range(rect.left // s, (rect.right - 1) // s + 1), range(rect.top // s, (rect.bottom - 1) // s + 1)
+
+    def draw(self, surface, offset_x, offset_y, area=None):
+        # Отрисовка видимых чанков со смещением камеры.
+        # area - часть экрана, которую нужно перерисовать (по умолчанию весь экран)
+        ox, oy = int(offset_x), int(offset_y)
+
+        if area is None:
+            area = surface.get_rect()
+
+        view = area.move(-ox, -oy)
+        cols, rows = self.chunk_range(view)
+
+        for cx in cols:
+            for cy in rows:
+                chunk = self.cache.get((self, cx, cy), lambda: self.build(cx, cy))
+                surface.blit(chunk, [cx * self.chunk_size + ox, cy * self.chunk_size + oy])
+
+        self.prefetch(view)
+
+    def prefetch(self, view):
+        # Заранее рисуем не больше одного соседнего чанка за кадр,
+        # чтобы при движении камеры не строить целую колонку сразу
+        cols, rows = self.chunk_range(view.inflate(2 * self.chunk_size, 0))
+
+        for cx in cols:
+            for cy in rows:
+                if (self, cx, cy) not in self.cache:
+                    self.cache.get((self, cx, cy), lambda: self.build(cx, cy))
+                    return
+
+
+class ParallaxLayer():
+    # Слой параллакса: одно изображение, повторенное по ширине уровня (или один раз),
+    # которое сдвигается в depth раз медленнее камеры. Хранится только само изображение,
+    # на каждом кадре рисуются лишь повторы, попадающие на экран.
+
+    def __init__(self, image, y, repeat, depth, width, height):
+        self.image = image
+        self.y = y
+        self.repeat = repeat
+        self.depth = depth
+        self.width = width
+        self.height = height
+
+    def draw(self, surface, offset_x, offset_y, area=None):
+        # area - часть экрана, которую нужно перерисовать (по умолчанию весь экран)
+        ox, oy = int(offset_x / self.depth), int(offset_y)
+
+        if area is None:
+            area = surface.get_rect()
+
+        # Слой занимает на экране прямоугольник уровня, сдвинутый на (ox, oy)
+        clip = area.clip(pygame.Rect(ox, oy, self.width, self.height))
+
+        if clip.width <= 0 or clip.height <= 0:
+            return
+
+        w, h = self.image.get_size()
+        y = oy + self.y
+
+        if self.repeat:
+            repeats = range((clip.left - ox) // w, (clip.right - 1 - ox) // w + 1)
+        else:
+            repeats = [0]
+
+        for i in repeats:
+            x = ox + i * w
+            part = pygame.Rect(x, y, w, h).clip(clip)
+
+            if part.width > 0 and part.height > 0:
+                surface.blit(self.image, part, part.move(-x, -y))
+
+
+# Снимок состояния уровня: enemies - по ENEMY_STATE чисел на врага,
+# coins/powerups - флаги "не собрано" в порядке начальных объектов
+LevelSnapshot = namedtuple("LevelSnapshot", "enemies coins powerups completed")
+ENEMY_STATE = 8
+
+# Снимок потокового уровня: chunks - чанки, состояние которых уже отличается от файла,
+# enemies - по 2 + ENEMY_STATE числа на врага (чанк, тип, состояние),
+# coins/powerups - пары (чанк, номер) собранных объектов (см. StreamingLevel.pickup_id)
+StreamSnapshot = namedtuple("StreamSnapshot", "enemies coins powerups completed chunks")
+
+# Снимок всей игры: номер уровня, стадия, персонаж и уровень
+GameSnapshot = namedtuple("GameSnapshot", "current_level stage hero level")
+
+# Неизменяемый кадр для отрисовки: уровень (его слои), стадия, смещение камеры,
+# видимые спрайты (изображение, прямоугольник на экране), статистика (сердца, жизни, очки)
+# и включен ли оверлей профилировщика
+RenderFrame = namedtuple("RenderFrame", "level stage offset sprites hud overlay")
+
+
+# Определение класса Level
+class Level():
+
+    # Конструктор класса, инициализация атрибутов объекта.
+    # map_data - уже прочитанные данные уровня (см. level_cache.load)
+    def __init__(self, file_path, map_data=None):
+        # Списки для хранения начальных объектов различных типов
+        self.starting_enemies = []
+        self.starting_coins = []
+        self.starting_powerups = []
+        self.starting_flag = []
+
+        # Группы спрайтов для разных типов объектов
+        self.enemies = pygame.sprite.Group()
+        self.coins = pygame.sprite.Group()
+        self.powerups = pygame.sprite.Group()
+        self.flag = pygame.sprite.Group()
+
+        # Группы для активных и неактивных спрайтов
+        self.active_sprites = pygame.sprite.Group()
+        self.inactive_sprites = pygame.sprite.Group()
+
+        # Пространственные хеши для быстрой проверки столкновений с героем
+        self.enemy_hash = SpatialHash()
+
+        # Спящие и активные враги по колонкам (активны только рядом с героем)
+        self.activity = ActivityIndex(2 * WIDTH)
+        self.coin_hash = SpatialHash()
+        self.powerup_hash = SpatialHash()
+        self.flag_hash = SpatialHash()
+
+        # Загрузка данных из файла (скомпилированного, если он свежее JSON)
+        if map_data is None:
+            map_data = level_cache.load(file_path)
+
+        # Инициализация размеров уровня и начальной позиции игрока
+        self.width = map_data['width'] * GRID_SIZE
+        self.height = map_data['height'] * GRID_SIZE
+        self.start_x = map_data['start'][0] * GRID_SIZE
+        self.start_y = map_data['start'][1] * GRID_SIZE
+
+        # Сетка статических блоков (размер расширяется, если блоки выходят за width/height)
+        self.tiles = TileMap.from_grid(map_data['grid'])
+
+        # Создание начальных объектов для разных типов
+
+        for item in map_data['bears']:
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            self.starting_enemies.append(Bear(x, y, bear_images))
+
+        for item in map_data['monsters']:
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            self.starting_enemies.append(Monster(x, y, monster_images))
+
+        for item in map_data['coins']:
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            self.starting_coins.append(Coin(x, y, assets.image(coin_img)))
+
+        for item in map_data['oneups']:
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            self.starting_powerups.append(OneUp(x, y, assets.image(oneup_img)))
+
+        for item in map_data['hearts']:
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+            self.starting_powerups.append(Heart(x, y, assets.image(heart_img)))
+
+        for i, item in enumerate(map_data['flag']):
+            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+
+            if i == 0:
+                img = assets.image(flag_img, rle=False)
+            else:
+                img = assets.image(flagpole_img, rle=False)
+
+            self.starting_flag.append(Flag(x, y, img))
+
+
+        # Музыка уровня (пустая строка или ненайденный файл - без музыки)
+        self.music = map_data.get('music', "")
+
+        # Цвет фона и слои параллакса (задний фон, сцена и любые другие)
+        self.background_color = map_data['background-color']
+        self.parallax_layers = self.load_parallax(map_data)
+
+        # Блоки и флаг рисуются по чанкам, только когда камера подходит к ним
+        self.chunks = ChunkCache(CHUNK_BUDGET)
+        self.inactive_layer = ChunkedLayer(self.width, self.height, self.paint_inactive, self.chunks)
+
+        # Инициализация физических параметров уровня
+        self.gravity = map_data['gravity']
+        self.terminal_velocity = map_data['terminal-velocity']
+
+        # Флаг для отслеживания завершения уровня
+        self.completed = False
+
+        # Добавление начальных объектов в соответствующие группы
+        self.enemies.add(self.starting_enemies)
+        self.coins.add(self.starting_coins)
+        self.powerups.add(self.starting_powerups)
+        self.flag.add(self.starting_flag)
+
+        # Добавление групп в группы активных и неактивных спрайтов
+        self.active_sprites.add(self.coins, self.enemies, self.powerups)
+        self.inactive_sprites.add(self.flag)
+
+        # Флаг неподвижен, его индексируем один раз
+        for s in self.starting_flag:
+            self.flag_hash.add(s)
+
+        # Порядок отрисовки активных спрайтов (как в группе active_sprites)
+        for i, s in enumerate(self.active_sprites):
+            s.draw_order = i
+
+        # Пакетная симуляция врагов (если включена и доступен NumPy)
+        self.enemy_engine = None
+
+        if BATCH_ENEMIES and enemy_engine is not None:
+            self.enemy_engine = enemy_engine.EnemyEngine(self, 2 * WIDTH, 2 * GRID_SIZE, frame_profiler)
+
+        # Начальное состояние для сброса уровня
+        self.initial_state = self.snapshot()
+
+    # Активные спрайты, пересекающие view (координаты уровня), в порядке отрисовки
+    def visible_sprites(self, view):
+        sprites = []
+
+        for index in (self.coin_hash, self.enemy_hash, self.powerup_hash):
+            for s in index.query(view):
+                if s.rect.colliderect(view):
+                    sprites.append(s)
+
+        sprites.sort(key=lambda s: s.draw_order)
+
+        return sprites
+
+    # Слои параллакса из списка 'parallax' в описании уровня, а если его нет -
+    # из старых ключей background-* и scenery-* (фон сдвигается в 3 раза медленнее камеры, сцена - в 2)
+    def load_parallax(self, map_data):
+        layers = map_data.get('parallax')
+
+        if layers is None:
+            layers = [{"img": map_data[name + '-img'],
+                       "position": map_data[name + '-position'],
+                       "repeat-x": map_data[name + '-repeat-x'],
+                       "fill-y": map_data[name + '-fill-y'],
+                       "depth": depth} for name, depth in (("background", 3), ("scenery", 2))]
+
+        result = []
+
+        for layer in layers:
+            if layer.get('img', "") == "":
+                continue
+
+            img = assets.image(layer['img'], None)
+
+            # Растягивание по высоте экрана с сохранением пропорций
+            if layer.get('fill-y', 0):
+                w = int(img.get_width() * HEIGHT / img.get_height())
+                img = assets.image(layer['img'], (w, HEIGHT))
+
+            if "bottom" in layer.get('position', "top"):
+                start_y = self.height - img.get_height()
+            else:
+                start_y = 0
+
+            result.append(ParallaxLayer(img, start_y, layer.get('repeat-x', 1), layer.get('depth', 1),
+                                        self.width, self.height))
+
+        return result
+
+    # Отрисовка фрагмента блоков и неактивных спрайтов
+    def paint_inactive(self, surface, area):
+        self.tiles.draw(surface, area)
+
+        for s in self.inactive_sprites:
+            if s.rect.colliderect(area):
+                surface.blit(s.image, [s.rect.x - area.x, s.rect.y - area.y])
+
+    # Примерный объем памяти, занятой уровнем (для кеша уровней)
+    def memory(self):
+        sprites = len(self.starting_enemies) + len(self.starting_coins) + len(self.starting_powerups)
+
+        return self.chunks.bytes + len(self.tiles.tiles) * 5 + sprites * 1024
+
+    # Подгрузка частей уровня рядом с view (обычный уровень загружен целиком)
+    def stream(self, view):
+        pass
+
+    # Обновление врагов на каждом кадре (view - видимая область уровня)
+    def update_enemies(self, hero, view):
+        awake = self.activity.update(hero.rect.x)
+
+        if self.enemy_engine is not None:
+            self.enemy_engine.update(hero, view, awake)
+        else:
+            for e in awake:
+                e.update(self, hero)
+                self.activity.move(e, e.rect.x)
+
+    # Снимок изменяемого состояния уровня: массивы, а не копии объектов
+    def snapshot(self):
+        if self.enemy_engine is not None:
+            self.enemy_engine.sync_all()
+
+        enemies = array('d')
+
+        for e in self.starting_enemies:
+            enemies.extend(e.snapshot())
+
+        return LevelSnapshot(enemies,
+                             bytearray(c.alive() for c in self.starting_coins),
+                             bytearray(p.alive() for p in self.starting_powerups),
+                             self.completed)
+
+    # Восстановление состояния из snapshot()
+    def restore(self, state):
+        self.completed = state.completed
+
+        for i, e in enumerate(self.starting_enemies):
+            e.restore(state.enemies[i * ENEMY_STATE:(i + 1) * ENEMY_STATE])
+
+            self.enemies.add(e)
+            self.active_sprites.add(e)
+            self.enemy_hash.add(e)
+            self.enemy_hash.move(e)
+            self.activity.move(e, e.rect.x)
+
+        # Монеты и бонусы: собранные убираются, несобранные возвращаются
+        for sprites, alive, group, index in ((self.starting_coins, state.coins, self.coins, self.coin_hash),
+                                             (self.starting_powerups, state.powerups, self.powerups, self.powerup_hash)):
+            for s, a in zip(sprites, alive):
+                if a:
+                    group.add(s)
+                    self.active_sprites.add(s)
+                    index.add(s)
+                elif s.alive():
+                    s.kill()
+                    index.remove(s)
+
+        if self.enemy_engine is not None:
+            self.enemy_engine.load()
+
+    # Метод для сброса уровня (восстановление начального состояния)
+    def reset(self):
+        self.restore(self.initial_state)
+
+
+# Типы врагов потоковых уровней: таблица в файле уровня, класс и кадры
+ENEMY_KINDS = [("bears", Bear, bear_images),
+               ("monsters", Monster, monster_images)]
+
+# Бонусы потоковых уровней: таблица, класс и изображение
+POWERUP_KINDS = [("oneups", OneUp, oneup_img),
+                 ("hearts", Heart, heart_img)]
+
+
+class StreamingLevel(Level):
+    # Уровень в потоковом формате (см. level_stream): блоки и объекты загружаются
+    # чанками рядом с камерой и выгружаются вдали от нее. Враги выгруженных чанков
+    # и собранные монеты и бонусы запоминаются и восстанавливаются при повторной загрузке.
+
+    def __init__(self, file_path):
+        self.reader = level_stream.StreamReader(file_path)
+        self.chunk_width = self.reader.chunk_cols * GRID_SIZE
+
+        # Загруженные чанки: номер -> монеты, бонусы и флаги чанка
+        self.loaded = {}
+
+        # Сохраненные враги выгруженных чанков: номер -> [(тип, состояние)]
+        self.saved_enemies = {}
+
+        # Собранные объекты: номер чанка -> множество pickup_id
+        self.collected = {}
+
+        # Общая часть (размеры, фон, физика) - как у обычного уровня, но без объектов
+        header = dict(self.reader.header)
+        header.update((name, []) for name in level_cache.SPAWN_TABLES)
+        header['grid'] = (0, 0, [], bytearray(), array('I'))
+        super().__init__(file_path, header)
+
+        self.tiles = StreamedTileMap(self.reader.cols, self.reader.rows, self.reader.chunk_cols)
+
+        # Пакетный движок работает со всей сеткой сразу, здесь он не используется
+        self.enemy_engine = None
+
+    # Номер объекта в чанке с учетом таблицы
+    @staticmethod
+    def pickup_id(table, i):
+        return level_cache.SPAWN_TABLES.index(table) << 20 | i
+
+    # Номер чанка, в котором находится x
+    def chunk_of(self, x):
+        return min(max(x // self.chunk_width, 0), len(self.reader) - 1)
+
+    # Подгрузка чанков рядом с view и выгрузка далеких
+    def stream(self, view):
+        center = view.centerx
+        w = self.chunk_width
+
+        for k in list(self.loaded):
+            if max(k * w - center, center - (k + 1) * w) > STREAM_UNLOAD_RADIUS:
+                self.unload_chunk(k)
+
+        first = self.chunk_of(center - STREAM_RADIUS)
+        last = self.chunk_of(center + STREAM_RADIUS)
+
+        for k in range(first, last + 1):
+            if k not in self.loaded:
+                self.load_chunk(k)
+
+    def add_sprite(self, s, group, index, draw_order):
+        s.draw_order = draw_order
+        group.add(s)
+        self.active_sprites.add(s)
+        index.add(s)
+
+    def load_chunk(self, k):
+        # Чанки слоя рисуются по блокам и неактивным спрайтам, которые меняются здесь
+        data = self.reader.read_chunk(k)
+
+        with self.chunks.lock:
+            self.add_chunk(k, data)
+
+    def add_chunk(self, k, data):
+        self.tiles.chunks[k] = TileMap.from_grid(data['grid'])
+        collected = self.collected.get(k, ())
+        chunk = self.loaded[k] = {"coins": [], "powerups": [], "flag": []}
+
+        # Враги: сохраненные при выгрузке или из файла, если чанк еще не выгружался
+        if k in self.saved_enemies:
+            enemies = []
+
+            for kind, state in self.saved_enemies.pop(k):
+                name, cls, images = ENEMY_KINDS[kind]
+                e = cls(0, 0, images)
+                e.restore(state)
+                enemies.append(e)
+        else:
+            enemies = [cls(x * GRID_SIZE, y * GRID_SIZE, images)
+                       for name, cls, images in ENEMY_KINDS for x, y in data[name]]
+
+        for i, e in enumerate(enemies):
+            self.add_sprite(e, self.enemies, self.enemy_hash, (1, k, i))
+            self.activity.move(e, e.rect.x)
+
+        for i, (x, y) in enumerate(data['coins']):
+            if self.pickup_id('coins', i) not in collected:
+                c = Coin(x * GRID_SIZE, y * GRID_SIZE, assets.image(coin_img))
+                self.add_sprite(c, self.coins, self.coin_hash, (0, k, i))
+                chunk["coins"].append((self.pickup_id('coins', i), c))
+
+        for name, cls, img in POWERUP_KINDS:
+            for i, (x, y) in enumerate(data[name]):
+                if self.pickup_id(name, i) not in collected:
+                    p = cls(x * GRID_SIZE, y * GRID_SIZE, assets.image(img))
+                    self.add_sprite(p, self.powerups, self.powerup_hash, (2, k, self.pickup_id(name, i)))
+                    chunk["powerups"].append((self.pickup_id(name, i), p))
+
+        for i, (x, y) in enumerate(data['flag']):
+            # Первая клетка флага в уровне - полотнище, остальные - древко
+            img = flag_img if [x, y] == self.reader.header.get('flag-top') else flagpole_img
+            f = Flag(x * GRID_SIZE, y * GRID_SIZE, assets.image(img, rle=False))
+            self.flag.add(f)
+            self.inactive_sprites.add(f)
+            self.flag_hash.add(f)
+            chunk["flag"].append(f)
+
+    def unload_chunk(self, k, save=True):
+        # Выгрузка чанка; save=False - без сохранения состояния (при сбросе уровня)
+        with self.chunks.lock:
+            self.remove_chunk(k, save)
+
+    def remove_chunk(self, k, save):
+        chunk = self.loaded.pop(k)
+        del self.tiles.chunks[k]
+
+        # Враги сохраняются по чанку, в котором они сейчас находятся
+        if save:
+            saved = self.saved_enemies[k] = []
+
+        for e in list(self.enemies):
+            if self.chunk_of(e.rect.x) == k:
+                if save:
+                    kind = [i for i, (name, cls, images) in enumerate(ENEMY_KINDS) if type(e) is cls][0]
+                    saved.append((kind, e.snapshot()))
+
+                e.kill()
+                self.enemy_hash.remove(e)
+                self.activity.remove(e)
+
+        for table, index in (("coins", self.coin_hash), ("powerups", self.powerup_hash)):
+            for pickup_id, s in chunk[table]:
+                if not s.alive():
+                    if save:
+                        self.collected.setdefault(k, set()).add(pickup_id)
+                else:
+                    s.kill()
+                    index.remove(s)
+
+        for f in chunk["flag"]:
+            f.kill()
+            self.flag_hash.remove(f)
+
+    # Выгрузка всех чанков без сохранения
+    def unload_all(self):
+        for k in list(self.loaded):
+            self.unload_chunk(k, save=False)
+
+    def snapshot(self):
+        enemies = array('d')
+        coins = array('q')
+        powerups = array('q')
+        chunks = sorted(set(self.loaded) | set(self.saved_enemies) | set(self.collected))
+
+        # Враги загруженных чанков - по текущему положению
+        current = {}
+
+        for e in self.enemies:
+            kind = [i for i, (name, cls, images) in enumerate(ENEMY_KINDS) if type(e) is cls][0]
+            current.setdefault(self.chunk_of(e.rect.x), []).append((kind, e.snapshot()))
+
+        for k in chunks:
+            for kind, state in (current.get(k, []) if k in self.loaded else self.saved_enemies.get(k, [])):
+                enemies.append(k)
+                enemies.append(kind)
+                enemies.extend(state)
+
+            collected = set(self.collected.get(k, ()))
+
+            if k in self.loaded:
+                for table in ("coins", "powerups"):
+                    collected.update(pickup_id for pickup_id, s in self.loaded[k][table] if not s.alive())
+
+            for pickup_id in sorted(collected):
+                out = coins if pickup_id >> 20 == level_cache.SPAWN_TABLES.index('coins') else powerups
+                out.extend([k, pickup_id])
+
+        return StreamSnapshot(enemies, coins, powerups, self.completed, array('q', chunks))
+
+    def restore(self, state):
+        self.unload_all()
+        self.completed = state.completed
+        self.saved_enemies = {k: [] for k in state.chunks}
+        self.collected = {}
+
+        n = 2 + ENEMY_STATE
+
+        for i in range(0, len(state.enemies), n):
+            record = state.enemies[i:i + n]
+            self.saved_enemies[int(record[0])].append((int(record[1]), record[2:]))
+
+        for pairs in (state.coins, state.powerups):
+            for i in range(0, len(pairs), 2):
+                self.collected.setdefault(pairs[i], set()).add(pairs[i + 1])
+
+    def reset(self):
+        self.unload_all()
+        self.saved_enemies = {}
+        self.collected = {}
+        self.completed = False
+
+        # Сразу загружаем начало уровня, чтобы герой не остался без блоков до следующего кадра
+        self.stream(pygame.Rect(self.start_x - WIDTH // 2, self.start_y, WIDTH, HEIGHT))
+
+    def memory(self):
+        sprites = len(self.enemies) + len(self.coins) + len(self.powerups)
+        tiles = sum(len(tilemap.tiles) for tilemap in self.tiles.chunks.values())
+
+        return self.chunks.bytes + tiles * 5 + sprites * 1024
+
+
+class LevelCache():
+    # Кеш построенных уровней. Следующий уровень читается и разбирается в фоновом
+    # потоке (только файлы и данные, без pygame), а объекты уровня создаются
+    # в основном потоке. Построенные уровни хранятся в LRU с ограничением памяти.
+
+    def __init__(self, budget=LEVEL_CACHE_BUDGET):
+        self.budget = budget
+        self.levels = OrderedDict()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def prefetch(self, file_path):
+        # Запуск фоновой подготовки уровня (потоковые уровни читаются по частям, их не готовим)
+        if level_stream.is_streamed(file_path):
+            return
+
+        if file_path not in self.levels and file_path not in self.pending:
+            self.pending[file_path] = self.executor.submit(level_cache.load, file_path)
+
+    def get(self, file_path):
+        # Уровень из кеша или построенный из подготовленных (или прочитанных сейчас) данных
+        level = self.levels.get(file_path)
+
+        if level is None:
+            if level_stream.is_streamed(file_path):
+                level = StreamingLevel(file_path)
+            else:
+                future = self.pending.pop(file_path, None)
+                map_data = future.result() if future is not None else None
+                level = Level(file_path, map_data)
+
+            self.levels[file_path] = level
+        else:
+            self.levels.move_to_end(file_path)
+
+        self.evict()
+
+        return level
+
+    def evict(self):
+        # Удаление давно не использованных уровней (последний полученный не удаляется)
+        while len(self.levels) > 1 and sum(level.memory() for level in self.levels.values()) > self.budget:
+            self.levels.popitem(last=False)
+
+
+class HeldKeys(frozenset):
+    # Набор удерживаемых клавиш, который можно использовать вместо
+    # pygame.key.get_pressed(): pressed[key] -> bool
+
+    def __getitem__(self, key):
+        return key in self
+
+
+class ScriptedInput():
+    # Заранее заданный ввод для режима без окна. На каждом кадре - набор
+    # удерживаемых клавиш, нажатия (KEYDOWN) вычисляются по разнице с прошлым кадром.
+
+    def __init__(self, frames):
+        self.frames = iter(frames)
+        self.held = HeldKeys()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        held = HeldKeys(next(self.frames))
+        keys = sorted(held - self.held)
+        self.held = held
+
+        return held, keys
+
+
+class RenderThread():
+    # Поток отрисовки: собирает последний опубликованный кадр (RenderFrame) на своей
+    # поверхности (canvas), пока симуляция считает следующий. Если сборка не успевает,
+    # ожидающий кадр заменяется новым, а симуляция не ждет. Pygame отпускает GIL на время
+    # копирования поверхностей, так что сборка и симуляция идут параллельно.
+    # На экран собранный кадр выводит основной поток (present): SDL разрешает показывать
+    # окно только из потока, который его создал (macOS, Windows).
+
+    def __init__(self, game):
+        self.game = game
+        self.canvas = game.window.copy()
+        self.pending = None
+
+        # Собранный, но еще не показанный кадр: composed и его измененные области
+        # (None - весь экран); пока кадр не показан, следующий не собирается
+        self.composed = False
+        self.dirty = None
+        self.busy = False
+        self.stopped = False
+        self.presented = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+        # Пока поток работает, профилировщик защищает общие данные блокировкой
+        frame_profiler.threaded = True
+        self.thread = threading.Thread(target=self.run, name="render", daemon=True)
+        self.thread.start()
+
+    def publish(self, frame):
+        with self.condition:
+            if self.pending is not None:
+                self.dropped += 1
+
+            self.pending = frame
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while (self.pending is None or self.composed) and not self.stopped:
+                    self.condition.wait()
+
+                if self.stopped:
+                    return
+
+                frame, self.pending = self.pending, None
+                self.busy = True
+
+            dirty = self.game.compose(frame, self.canvas)
+
+            with self.condition:
+                self.composed, self.dirty, self.busy = True, dirty, False
+                self.condition.notify_all()
+
+    def present(self):
+        # Вывод собранного кадра на экран (в основном потоке); False - кадр еще не готов
+        with self.condition:
+            if not self.composed:
+                return False
+
+            dirty = self.dirty
+
+        window = self.game.window
+
+        with frame_profiler.phase("draw.flip"):
+            if dirty is None:
+                window.blit(self.canvas, (0, 0))
+            else:
+                for area in dirty:
+                    window.blit(self.canvas, area, area)
+
+        self.game.show(dirty)
+
+        with self.condition:
+            self.composed = False
+            self.presented += 1
+            self.condition.notify_all()
+
+        return True
+
+    def stop(self):
+        # Остановка после того, как текущий и ожидающий кадры собраны и показаны
+        while True:
+            self.present()
+
+            with self.condition:
+                if self.pending is None and not self.busy and not self.composed:
+                    self.stopped = True
+                    self.condition.notify_all()
+                    break
+
+                self.condition.wait()
+
+        self.thread.join()
+        frame_profiler.threaded = False
+
+
+# Определение класса Game
+class Game():
+
+    # Константы для состояний игры
+    SPLASH = 0
+    START = 1
+    PLAYING = 2
+    PAUSED = 3
+    LEVEL_COMPLETED = 4
+    GAME_OVER = 5
+    VICTORY = 6
 
     # Инициализация объекта игры
-    def __init__(self):
+    def __init__(self, headless=False):
+        self.headless = headless
+
+        init(headless)
+
+        # Без окна: переключаемся на видеодрайвер SDL "dummy".
+        # Поверхность экрана все равно нужна для convert()/convert_alpha().
+        if headless and pygame.display.get_driver() != "dummy":
+            pygame.display.quit()
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            pygame.display.init()
+
         # Создание окна pygame
         self.window = pygame.display.set_mode([WIDTH, HEIGHT])
         pygame.display.set_caption(TITLE)
         self.clock = pygame.time.Clock()
         self.done = False
 
+        # Построенные уровни и фоновая подготовка следующего
+        self.level_cache = LevelCache()
+
+        # Что было нарисовано в прошлом кадре (для перерисовки по dirty rects)
+        self.last_frame = None
+        self.last_rects = []
+
+        # Запись ввода (replay.Recording), если она включена
+        self.recording = None
+
+        # Поток отрисовки (RenderThread), пока идет loop() с PIPELINED_RENDER
+        self.renderer = None
+
         # Инициализация игровых параметров
         self.reset()
 
     # Метод для начала уровня
     def start(self):
-        self.level = Level(levels[self.current_level])
+        self.level = self.level_cache.get(levels[self.current_level])
         self.level.reset()
         self.hero.respawn(self.level)
 
+        # Эффекты загружаются один раз, до начала игры; без окна игра идет без звука
+        if not self.headless:
+            sounds.preload(sound_effects)
+            sounds.play_music(self.level.music)
+
+        # Следующий уровень готовится в фоне, пока играется текущий
+        if self.current_level + 1 < len(levels):
+            self.level_cache.prefetch(levels[self.current_level + 1])
+
     # Метод для перехода к следующему уровню
     def advance(self):
         self.current_level += 1
@@ -693,10 +2407,38 @@ class Game():
         self.start()
         self.stage = Game.SPLASH
 
+    # Снимок состояния игры (для контрольных точек и повтора уровня)
+    def snapshot(self):
+        return GameSnapshot(self.current_level, self.stage, self.hero.snapshot(), self.level.snapshot())
+
+    # Хеш состояния игры (для проверки, что повтор записи дал тот же результат)
+    def state_hash(self):
+        state = self.snapshot()
+        h = hashlib.sha1(struct.pack("<ii?", state.current_level, state.stage, state.level.completed))
+
+        for a in (state.hero, state.level.enemies):
+            h.update(level_cache.to_little_endian(a).tobytes())
+
+        h.update(state.level.coins)
+        h.update(state.level.powerups)
+
+        return h.hexdigest()
+
+    # Восстановление состояния из snapshot()
+    def restore(self, state):
+        if state.current_level != self.current_level:
+            self.current_level = state.current_level
+            self.level = self.level_cache.get(levels[self.current_level])
+
+        self.stage = state.stage
+        self.hero.restore(state.hero)
+        self.level.restore(state.level)
+        self.level.stream(self.viewport())
+
     # Метод для отображения заставки
     def display_splash(self, surface):
-        line1 = FONT_LG.render(TITLE, 1, DARK_BLUE)
-        line2 = FONT_SM.render("Press any key to start.", 1, WHITE)
+        line1 = text_cache.render(FONT_LG, TITLE, DARK_BLUE)
+        line2 = text_cache.render(FONT_SM, "Press any key to start.", WHITE)
 
         x1 = WIDTH / 2 - line1.get_width() / 2
         y1 = HEIGHT / 3 - line1.get_height() / 2
@@ -709,8 +2451,8 @@ class Game():
 
     # Метод для отображения сообщения
     def display_message(self, surface, primary_text, secondary_text):
-        line1 = FONT_MD.render(primary_text, 1, WHITE)
-        line2 = FONT_SM.render(secondary_text, 1, WHITE)
+        line1 = text_cache.render(FONT_MD, primary_text, WHITE)
+        line2 = text_cache.render(FONT_SM, secondary_text, WHITE)
 
         x1 = WIDTH / 2 - line1.get_width() / 2
         y1 = HEIGHT / 3 - line1.get_height() / 2
@@ -721,42 +2463,44 @@ class Game():
         surface.blit(line1, (x1, y1))
         surface.blit(line2, (x2, y2))
 
-    # Метод для отображения статистики
-    def display_stats(self, surface):
-        hearts_text = FONT_SM.render("Hearts: " + str(self.hero.hearts), 1, WHITE)
-        lives_text = FONT_SM.render("Lives: " + str(self.hero.lives), 1, WHITE)
-        score_text = FONT_SM.render("Score: " + str(self.hero.score), 1, WHITE)
-
-        surface.blit(score_text, (WIDTH - score_text.get_width() - 32, 32))
-        surface.blit(hearts_text, (32, 32))
-        surface.blit(lives_text, (32, 64))
+    # Метод для подготовки текста статистики: список (поверхность, прямоугольник)
+    # (hud - сердца, жизни и очки; по умолчанию - текущие значения персонажа)
+    def stats_blits(self, hud=None):
+        hearts, lives, score = hud or (self.hero.hearts, self.hero.lives, self.hero.score)
+        hearts_text = text_cache.number(FONT_SM, "Hearts: ", hearts, WHITE)
+        lives_text = text_cache.number(FONT_SM, "Lives: ", lives, WHITE)
+        score_text = text_cache.number(FONT_SM, "Score: ", score, WHITE)
 
-    # Метод для обработки событий
-    def process_events(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.done = True
+        return [(score_text, score_text.get_rect(topleft=(WIDTH - score_text.get_width() - 32, 32))),
+                (hearts_text, hearts_text.get_rect(topleft=(32, 32))),
+                (lives_text, lives_text.get_rect(topleft=(32, 64)))]
 
-            elif event.type == pygame.KEYDOWN:
-                if self.stage == Game.SPLASH or self.stage == Game.START:
-                    self.stage = Game.PLAYING
+    # Метод для отображения статистики
+    def display_stats(self, surface, stats=None):
+        for text, rect in stats or self.stats_blits():
+            surface.blit(text, rect)
 
-                elif self.stage == Game.PLAYING:
-                    if event.key == JUMP:
-                        self.hero.jump(self.level.blocks)
+    # Метод для обработки нажатия клавиши
+    def handle_key(self, key):
+        if self.stage == Game.SPLASH or self.stage == Game.START:
+            self.stage = Game.PLAYING
 
-                elif self.stage == Game.PAUSED:
-                    pass
+        elif self.stage == Game.PLAYING:
+            if key == JUMP:
+                self.hero.jump(self.level.tiles)
 
-                elif self.stage == Game.LEVEL_COMPLETED:
-                    self.advance()
+        elif self.stage == Game.PAUSED:
+            pass
 
-                elif self.stage == Game.VICTORY or self.stage == Game.GAME_OVER:
-                    if event.key == pygame.K_r:
-                        self.reset()
+        elif self.stage == Game.LEVEL_COMPLETED:
+            self.advance()
 
-        pressed = pygame.key.get_pressed()
+        elif self.stage == Game.VICTORY or self.stage == Game.GAME_OVER:
+            if key == pygame.K_r:
+                self.reset()
 
+    # Метод для обработки удерживаемых клавиш
+    def handle_pressed(self, pressed):
         if self.stage == Game.PLAYING:
             if pressed[LEFT]:
                 self.hero.move_left()
@@ -765,22 +2509,73 @@ class Game():
             else:
                 self.hero.stop()
 
+    # Метод для обработки отладочных клавиш профилировщика
+    def handle_profiler_key(self, key):
+        name = os.path.join(PROFILES_DIR, time.strftime("frames-%Y%m%d-%H%M%S"))
+
+        if key == PROFILER_OVERLAY:
+            frame_profiler.overlay = not frame_profiler.overlay
+
+        elif key == PROFILER_CAPTURE:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+
+            # Куда сохранен результат, показывается в заголовке окна
+            if frame_profiler.toggle_capture(name + ".prof"):
+                pygame.display.set_caption("%s - recording cProfile" % TITLE)
+            else:
+                pygame.display.set_caption("%s - cProfile saved to %s.prof" % (TITLE, name))
+
+        elif key == PROFILER_EXPORT:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            frame_profiler.export_csv(name + ".csv")
+            frame_profiler.export_json(name + ".json")
+            pygame.display.set_caption("%s - frame timings saved to %s.csv and .json" % (TITLE, name))
+
+    # Метод для обработки событий
+    def process_events(self):
+        keys = []
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.done = True
+
+            elif event.type == pygame.KEYDOWN:
+                if event.key in (PROFILER_OVERLAY, PROFILER_CAPTURE, PROFILER_EXPORT):
+                    self.handle_profiler_key(event.key)
+                else:
+                    self.handle_key(event.key)
+                    keys.append(event.key)
+
+        pressed = pygame.key.get_pressed()
+        self.handle_pressed(pressed)
+
+        if self.recording is not None:
+            self.recording.add([k for k in RECORDED_KEYS if pressed[k]], keys)
+
     # Метод для обновления состояния игры
     def update(self):
+        with frame_profiler.phase("update.stream"):
+            self.level.stream(self.viewport())
+
         if self.stage == Game.PLAYING:
-            self.hero.update(self.level)
-            self.level.enemies.update(self.level, self.hero)
+            with frame_profiler.phase("update.hero"):
+                self.hero.update(self.level)
+
+            with frame_profiler.phase("update.enemies"):
+                self.level.update_enemies(self.hero, self.viewport())
 
         if self.level.completed:
             if self.current_level < len(levels) - 1:
                 self.stage = Game.LEVEL_COMPLETED
             else:
                 self.stage = Game.VICTORY
-            pygame.mixer.music.stop()
+
+            sounds.stop_music()
 
         elif self.hero.lives == 0:
             self.stage = Game.GAME_OVER
-            pygame.mixer.music.stop()
+
+            sounds.stop_music()
 
         elif self.hero.hearts == 0:
             self.level.reset()
@@ -797,56 +2592,275 @@ class Game():
 
         return x, 0
 
-    # Метод для отрисовки состояния игры
+    # Видимая область уровня (в координатах уровня)
+    def viewport(self):
+        offset_x, offset_y = self.calculate_offset()
+
+        return pygame.Rect(-int(offset_x), -int(offset_y), WIDTH, HEIGHT)
+
+    # Метод для отрисовки слоев уровня на surface (area - часть экрана, по умолчанию весь)
+    def draw_layers(self, surface, level, offset_x, offset_y, area=None):
+        if level.background_color != "":
+            surface.fill(level.background_color, area)
+
+        for layer in level.parallax_layers:
+            layer.draw(surface, offset_x, offset_y, area)
+
+        level.inactive_layer.draw(surface, offset_x, offset_y, area)
+
+    # Метод для отрисовки состояния игры: сразу или в потоке отрисовки
     def draw(self):
+        frame = self.render_frame()
+
+        if self.renderer is not None:
+            # Сначала на экран выводится кадр, собранный потоком отрисовки
+            self.renderer.present()
+            self.renderer.publish(frame)
+        else:
+            self.present(frame)
+
+    # Метод для снимка того, что нужно нарисовать (выполняется в потоке симуляции)
+    def render_frame(self):
         offset_x, offset_y = self.calculate_offset()
+        ox, oy = int(offset_x), int(offset_y)
+
+        # Только спрайты, попадающие на экран, в экранных координатах
+        view = pygame.Rect(-ox, -oy, WIDTH, HEIGHT)
+        self.level.stream(view)
+
+        with frame_profiler.phase("draw.sprites"):
+            sprites = [(s.image, s.rect.move(ox, oy)) for s in self.level.visible_sprites(view)]
+
+            # Отображение персонажа (с учетом неуязвимости)
+            if self.hero.invincibility % 3 < 2:
+                sprites.append((self.hero.image, self.hero.rect.move(ox, oy)))
+
+        return RenderFrame(self.level, self.stage, (offset_x, offset_y), tuple(sprites),
+                           (self.hero.hearts, self.hero.lives, self.hero.score), frame_profiler.overlay)
+
+    # Метод для отрисовки кадра на экране
+    def present(self, frame):
+        self.show(self.compose(frame, self.window))
+
+    # Метод для сборки кадра на поверхности surface размером с окно (только по данным
+    # кадра, не по состоянию игры); возвращает измененные области или None - весь экран
+    def compose(self, frame, surface):
+        offset_x, offset_y = frame.offset
+        ox, oy = int(offset_x), int(offset_y)
+        sprites = frame.sprites
+        frame.level.chunks.begin_frame()
+
+        with frame_profiler.phase("draw.hud"):
+            stats = self.stats_blits(frame.hud)
+
+        frame_key = (frame.level, frame.stage, ox, oy, frame.overlay)
+
+        # Если камера не двигалась, перерисовываем только изменившиеся области
+        # (с оверлеем профилировщика экран всегда перерисовывается целиком)
+        if DIRTY_RECTS and frame.stage == Game.PLAYING and frame_key == self.last_frame and not frame.overlay:
+            dirty = merge_rects(self.last_rects + [r for _, r in sprites] + [r for _, r in stats])
 
-        # Заполнение активного слоя
-        self.level.active_layer.fill(TRANSPARENT)
-        self.level.active_sprites.draw(self.level.active_layer)
+            for area in dirty:
+                surface.set_clip(area)
 
-        # Отображение персонажа (с учетом неуязвимости)
-        if self.hero.invincibility % 3 < 2:
-            self.level.active_layer.blit(self.hero.image, [self.hero.rect.x, self.hero.rect.y])
+                with frame_profiler.phase("draw.layers"):
+                    self.draw_layers(surface, frame.level, offset_x, offset_y, area)
 
-        # Отображение слоев уровня на экране
-        self.window.blit(self.level.background_layer, [offset_x / 3, offset_y])
-        self.window.blit(self.level.scenery_layer, [offset_x / 2, offset_y])
-        self.window.blit(self.level.inactive_layer, [offset_x, offset_y])
-        self.window.blit(self.level.active_layer, [offset_x, offset_y])
+                with frame_profiler.phase("draw.sprites"):
+                    for image, rect in sprites:
+                        if rect.colliderect(area):
+                            surface.blit(image, rect)
 
-        # Отображение статистики
-        self.display_stats(self.window)
+                with frame_profiler.phase("draw.hud"):
+                    self.display_stats(surface, stats)
 
+            surface.set_clip(None)
+
+        else:
+            dirty = None
+
+            with frame_profiler.phase("draw.layers"):
+                self.draw_layers(surface, frame.level, offset_x, offset_y)
+
+            with frame_profiler.phase("draw.sprites"):
+                for image, rect in sprites:
+                    surface.blit(image, rect)
+
+            # Отображение статистики
+            with frame_profiler.phase("draw.hud"):
+                self.display_stats(surface, stats)
+                self.draw_messages(surface, frame.stage)
+
+                if frame.overlay:
+                    self.draw_profiler(surface)
+
+        self.last_frame = frame_key
+        self.last_rects = [r for _, r in sprites] + [r for _, r in stats]
+
+        return dirty
+
+    # Метод для обновления экрана (dirty - измененные области, None - весь экран);
+    # вызывается только из основного потока
+    def show(self, dirty):
+        with frame_profiler.phase("draw.flip"):
+            if dirty is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty)
+
+    # Метод для отображения оверлея профилировщика
+    def draw_profiler(self, surface):
+        frame_profiler.draw(surface, load_font(FONT_PROFILER), WHITE)
+
+    # Метод для отображения экрана, соответствующего состоянию игры
+    def draw_messages(self, surface, stage=None):
         # Отображение соответствующего экрана в зависимости от состояния игры
-        if self.stage == Game.SPLASH:
-            self.display_splash(self.window)
-        elif self.stage == Game.START:
-            self.display_message(self.window, "Ready?!!!", "Press any key to start.")
-        elif self.stage == Game.PAUSED:
-            pass
-        elif self.stage == Game.LEVEL_COMPLETED:
-            self.display_message(self.window, "Level Complete", "Press any key to continue.")
-        elif self.stage == Game.VICTORY:
-            self.display_message(self.window, "You Win!", "Press 'R' to restart.")
-        elif self.stage == Game.GAME_OVER:
-            self.display_message(self.window, "Game Over", "Press 'R' to restart.")
+        stage = self.stage if stage is None else stage
 
-        # Обновление экрана
-        pygame.display.flip()
+        if stage == Game.SPLASH:
+            self.display_splash(surface)
+        elif stage == Game.START:
+            self.display_message(surface, "Ready?!!!", "Press any key to start.")
+        elif stage == Game.PAUSED:
+            pass
+        elif stage == Game.LEVEL_COMPLETED:
+            self.display_message(surface, "Level Complete", "Press any key to continue.")
+        elif stage == Game.VICTORY:
+            self.display_message(surface, "You Win!", "Press 'R' to restart.")
+        elif stage == Game.GAME_OVER:
+            self.display_message(surface, "Game Over", "Press 'R' to restart.")
+
+    # Запуск и остановка потока отрисовки (если включен PIPELINED_RENDER)
+    def start_renderer(self):
+        if PIPELINED_RENDER and self.renderer is None:
+            self.renderer = RenderThread(self)
+
+    def stop_renderer(self):
+        if self.renderer is not None:
+            self.renderer.stop()
+            self.renderer = None
 
     # Основной цикл игры
     def loop(self):
-        while not self.done:
-            self.process_events()
+        self.start_renderer()
+
+        try:
+            while not self.done:
+                frame_profiler.begin_frame()
+
+                with frame_profiler.phase("events"):
+                    self.process_events()
+
+                with frame_profiler.phase("update"):
+                    self.update()
+
+                with frame_profiler.phase("draw"):
+                    self.draw()
+
+                frame_profiler.end_frame()
+                self.clock.tick(FPS)
+        finally:
+            self.stop_renderer()
+
+    # Один шаг симуляции с заданным вводом (без отрисовки и таймера)
+    def step(self, pressed, keys=()):
+        with frame_profiler.phase("events"):
+            for key in keys:
+                self.handle_key(key)
+
+            self.handle_pressed(pressed)
+
+        with frame_profiler.phase("update"):
             self.update()
-            self.draw()
-            self.clock.tick(FPS)
+
+    # Прогон готового ввода: inputs - последовательность (удерживаемые клавиши, нажатия).
+    # Без realtime - так быстро, как позволяет процессор и без отрисовки,
+    # с realtime - с отрисовкой и скоростью FPS, как в loop().
+    def run_input(self, inputs, max_steps=None, realtime=False):
+        steps = 0
+
+        if realtime:
+            self.start_renderer()
+
+        try:
+            for pressed, keys in inputs:
+                if self.done or (max_steps is not None and steps >= max_steps):
+                    break
+
+                frame_profiler.begin_frame()
+                self.step(HeldKeys(pressed), keys)
+
+                if realtime:
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            self.done = True
+
+                    with frame_profiler.phase("draw"):
+                        self.draw()
+
+                frame_profiler.end_frame()
+                steps += 1
+
+                if realtime:
+                    self.clock.tick(FPS)
+        finally:
+            self.stop_renderer()
+
+        return steps
+
+    # Прогон симуляции с фиксированным шагом так быстро, как позволяет процессор.
+    # script - последовательность кадров, каждый кадр - набор удерживаемых клавиш.
+    def simulate(self, script, max_steps=None):
+        return self.run_input(ScriptedInput(script), max_steps)
+
+    # Повтор записи ввода (replay.Recording); возвращает True, если итоговое
+    # состояние совпало с записанным
+    def replay(self, recording, realtime=False):
+        self.run_input(recording, realtime=realtime)
+
+        return recording.header.get("hash") in (None, self.state_hash())
 
 # Запуск игры при запуске файла
 if __name__ == "__main__":
-    game = Game()
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument("--record", metavar="FILE", help="record input of this session to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="replay recorded input from FILE")
+    parser.add_argument("--headless", action="store_true", help="replay without a window at full speed")
+    parser.add_argument("--pipelined", action="store_true", help="draw in a separate thread while the next frame is simulated")
+    parser.add_argument("--level", metavar="FILE", nargs="+",
+                        help="play these level files (.json or streamed .lvs) instead of the built-in levels")
+    args = parser.parse_args()
+
+    PIPELINED_RENDER = PIPELINED_RENDER or args.pipelined
+
+    # Запись проигрывается на тех уровнях, на которых сделана (если не заданы другие)
+    recording = replay.load(args.replay) if args.replay else None
+
+    if args.level:
+        levels[:] = args.level
+    elif recording is not None and recording.header.get("levels"):
+        levels[:] = recording.header["levels"]
+
+    for path in levels:
+        if not os.path.exists(path):
+            parser.error("level file not found: %s" % path)
+
+    game = Game(headless=args.headless)
     game.start()
-    game.loop()
+
+    if recording is not None:
+        same = game.replay(recording, realtime=not args.headless)
+        print("Replayed %d frames, state %s (%s)" % (len(recording), game.state_hash(),
+                                                     "matches recording" if same else "DIFFERS from recording"))
+    else:
+        if args.record:
+            game.recording = replay.Recording({"levels": levels})
+
+        game.loop()
+
+        if args.record:
+            game.recording.header["hash"] = game.state_hash()
+            replay.save(game.recording, args.record)
+
     pygame.quit()
     sys.exit()
\ No newline at end of file
@@ -0,0 +1,213 @@
+import cProfile
+import csv
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from itertools import islice
+
+# Профилировщик кадров: время по фазам кадра (события, обновление, отрисовка и их части),
+# счетчики проверок столкновений, скользящие перцентили, оверлей на экране,
+# экспорт покадровых данных в CSV/JSON и запись cProfile по требованию.
+# Фазы можно отмечать из нескольких потоков (симуляция и отрисовка): у каждого потока
+# свой стек вложенных фаз, а пока включен threaded, общие данные защищены блокировкой
+# (в обычном однопоточном режиме счетчики обходятся без нее).
+
+# Сколько последних кадров учитывать в перцентилях
+WINDOW = 600
+
+# Сколько кадров хранить для экспорта (5 минут при 60 FPS)
+HISTORY = 18000
+
+# Как часто обновлять текст оверлея (секунды): перцентили пересчитываются
+# и строки рендерятся заново не на каждом кадре
+OVERLAY_REFRESH = 0.25
+
+
+class Phase():
+    # Контекстный менеджер фазы кадра. Время вложенных фаз вычитается из внешней,
+    # так что сумма всех фаз равна времени кадра.
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.stack().append(0.0)
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stack = self.profiler.stack()
+        nested = stack.pop()
+
+        if self.profiler.threaded:
+            with self.profiler.lock:
+                self.profiler.times[self.name] += elapsed - nested
+        else:
+            self.profiler.times[self.name] += elapsed - nested
+
+        if stack:
+            stack[-1] += elapsed
+
+
+class FrameProfiler():
+
+    def __init__(self, window=WINDOW, history=HISTORY):
+        self.window = window
+        self.frames = deque(maxlen=history)
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # True, пока фазы и счетчики могут отмечаться из другого потока (см. main.RenderThread)
+        self.threaded = False
+        self.frame_started = None
+        self.overlay = False
+        self.capture = None
+
+        # Отрендеренные строки оверлея, ключ (шрифт, цвет) и время обновления
+        self.overlay_lines = []
+        self.overlay_key = None
+        self.overlay_updated = 0.0
+
+    def stack(self):
+        # Стек вложенных фаз текущего потока
+        stack = getattr(self.local, "stack", None)
+
+        if stack is None:
+            stack = self.local.stack = []
+
+        return stack
+
+    def phase(self, name):
+        # with profiler.phase("update.hero"): ...
+        return Phase(self, name)
+
+    def count(self, name, n=1):
+        # Счетчик за текущий кадр (например, число проверок столкновений)
+        if self.threaded:
+            with self.lock:
+                self.counts[name] += n
+        else:
+            self.counts[name] += n
+
+    def begin_frame(self):
+        with self.lock:
+            self.times.clear()
+            self.counts.clear()
+            self.frame_started = time.perf_counter()
+
+    def end_frame(self):
+        with self.lock:
+            if self.frame_started is None:
+                return
+
+            record = {"total": time.perf_counter() - self.frame_started}
+            record.update(self.times)
+            record.update(("count." + k, v) for k, v in self.counts.items())
+            self.frames.append(record)
+            self.frame_started = None
+
+    def recent(self):
+        # Последние window кадров
+        with self.lock:
+            return list(islice(reversed(self.frames), self.window))
+
+    def history(self):
+        # Все сохраненные кадры
+        with self.lock:
+            return list(self.frames)
+
+    def percentiles(self, name, ps=(50, 95, 99), frames=None):
+        # Перцентили по последним window кадрам (в секундах)
+        values = sorted(f.get(name, 0) for f in (frames or self.recent()))
+
+        if not values:
+            return [0.0 for p in ps]
+
+        return [values[min(len(values) - 1, len(values) * p // 100)] for p in ps]
+
+    def names(self, frames=None):
+        # Все фазы и счетчики, встречавшиеся в кадрах
+        names = {}
+
+        for f in (self.history() if frames is None else frames):
+            names.update(dict.fromkeys(f))
+
+        return list(names)
+
+    def summary(self):
+        # {фаза: {"p50": ..., "p95": ..., "p99": ...}}, время в миллисекундах
+        frames = self.recent()
+        result = {}
+
+        for name in self.names(frames):
+            scale = 1 if name.startswith("count.") else 1000
+            p50, p95, p99 = self.percentiles(name, frames=frames)
+            result[name] = {"p50": p50 * scale, "p95": p95 * scale, "p99": p99 * scale}
+
+        return result
+
+    def export_csv(self, path):
+        frames = self.history()
+        names = self.names(frames)
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame"] + names)
+
+            for i, frame in enumerate(frames):
+                writer.writerow([i] + [frame.get(name, 0) for name in names])
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({"summary": self.summary(), "frames": self.history()}, f)
+
+    def toggle_capture(self, path):
+        # Запуск записи cProfile или остановка с сохранением в path;
+        # возвращает True, если запись идет
+        if self.capture is None:
+            self.capture = cProfile.Profile()
+            self.capture.enable()
+            return True
+
+        self.capture.disable()
+        self.capture.dump_stats(path)
+        self.capture = None
+
+        return False
+
+    def draw(self, surface, font, color):
+        # Оверлей: перцентили по фазам (мс) и счетчики последнего кадра.
+        # Строки рендерятся заново раз в OVERLAY_REFRESH секунд
+        now = time.perf_counter()
+
+        if (font, color) != self.overlay_key or now - self.overlay_updated >= OVERLAY_REFRESH:
+            self.overlay_lines = [font.render(line, 1, color, (0, 0, 0)) for line in self.overlay_text()]
+            self.overlay_key = (font, color)
+            self.overlay_updated = now
+
+        y = 8
+
+        for text in self.overlay_lines:
+            surface.blit(text, (8, y))
+            y += text.get_height()
+
+    def overlay_text(self):
+        # Строки оверлея
+        lines = ["phase              p50    p95    p99"]
+
+        for name, p in sorted(self.summary().items()):
+            if not name.startswith("count."):
+                lines.append("%-16s %6.2f %6.2f %6.2f" % (name, p["p50"], p["p95"], p["p99"]))
+
+        frames = self.recent()
+
+        if frames:
+            for name, value in sorted(frames[0].items()):
+                if name.startswith("count."):
+                    lines.append("%-16s %6d" % (name[6:], value))
+
+        return lines
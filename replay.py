@@ -0,0 +1,140 @@
+import json
+import os
+import struct
+import zlib
+
+# Записи ввода для повтора игры. Для каждого кадра хранится набор удерживаемых клавиш
+# и список нажатий (KEYDOWN), но записываются только изменения: сколько кадров
+# прошло с прошлой записи, какие клавиши стали удерживаемыми, какие отпущены и какие нажаты.
+# Все числа - varint, тело сжато zlib. Без pygame, коды клавиш - обычные целые.
+
+MAGIC = b"RPL\x01"
+
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+
+    out.append(n)
+
+
+def read_varint(data, pos):
+    # Число и позиция после него
+    n = shift = 0
+
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+
+        if b < 0x80:
+            return n, pos
+
+
+class Recording():
+    # Записанный ввод: add() на каждом кадре, итерация возвращает (held, keys) по кадрам
+
+    def __init__(self, header=None):
+        self.header = dict(header or {})
+        self.data = bytearray()
+        self.count = 0
+        self.held = frozenset()
+
+        # Кадров без изменений с последней записи
+        self.gap = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, held, keys=()):
+        held = frozenset(held)
+        self.count += 1
+
+        if held == self.held and not keys:
+            self.gap += 1
+            return
+
+        pressed = sorted(held - self.held)
+        released = sorted(self.held - held)
+
+        write_varint(self.data, self.gap)
+
+        for group in (pressed, released, keys):
+            write_varint(self.data, len(group))
+
+            for key in group:
+                write_varint(self.data, key)
+
+        self.held = held
+        self.gap = 0
+
+    def __iter__(self):
+        held = frozenset()
+        pos = frame = 0
+
+        while pos < len(self.data):
+            gap, pos = read_varint(self.data, pos)
+
+            for i in range(gap):
+                yield held, []
+
+            groups = []
+
+            for i in range(3):
+                count, pos = read_varint(self.data, pos)
+                group = []
+
+                for j in range(count):
+                    key, pos = read_varint(self.data, pos)
+                    group.append(key)
+
+                groups.append(group)
+
+            pressed, released, keys = groups
+            held = (held | set(pressed)) - set(released)
+            frame += gap + 1
+
+            yield held, keys
+
+        # Кадры без изменений после последней записи
+        for i in range(self.count - frame):
+            yield held, []
+
+    def to_bytes(self):
+        header = dict(self.header, frames=self.count)
+        header_bytes = json.dumps(header).encode("utf-8")
+
+        return MAGIC + zlib.compress(struct.pack("<I", len(header_bytes)) + header_bytes + bytes(self.data))
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("not an input recording")
+
+        data = zlib.decompress(data[len(MAGIC):])
+        header_len, = struct.unpack("<I", data[:4])
+        header = json.loads(data[4:4 + header_len].decode("utf-8"))
+
+        count = header.pop("frames")
+        recording = cls(header)
+        recording.data = bytearray(data[4 + header_len:])
+        recording.count = count
+
+        return recording
+
+
+def save(recording, path):
+    # Запись через временный файл, как и скомпилированные уровни
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(recording.to_bytes())
+
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return Recording.from_bytes(f.read())
@@ -0,0 +1,19 @@
+import benchmark
+
+# Сравнение с базовым запуском не должно считать регрессией шум коротких замеров
+
+
+def report(load_seconds, steps_per_second):
+    return {"steps": 600, "frames": 120,
+            "results": [{"tiles": 100, "load_seconds": load_seconds, "steps_per_second": steps_per_second}]}
+
+
+def test_compare_ignores_noise_below_floor():
+    # Загрузка 0.4 -> 0.9 мс и 100000 -> 60000 шагов/с (6 -> 10 мс на замер)
+    assert benchmark.compare(report(0.0009, 60000), report(0.0004, 100000), 0.2) == []
+
+
+def test_compare_reports_slowdown_above_floor():
+    regressions = benchmark.compare(report(0.2, 1000), report(0.1, 2000), 0.2)
+
+    assert [metric for tiles, metric, change in regressions] == ["load_seconds", "steps_per_second"]
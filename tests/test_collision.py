@@ -0,0 +1,45 @@
+import pygame
+
+import main
+
+# Враги, расставленные в уровне внутри блоков, выталкиваются как в исходной игре
+
+
+def embedded_bear(level):
+    return next(e for e in level.enemies if (e.start_x, e.start_y) == (320, 448))
+
+
+def test_embedded_spawn():
+    level = main.Level("levels/world-2.json")
+    level.reset()
+    hero = main.Character(main.hero_images)
+    bear = embedded_bear(level)
+
+    view = pygame.Rect(0, 0, main.WIDTH, main.HEIGHT)
+    level.update_enemies(hero, view)
+
+    assert (bear.rect.x, bear.rect.y, bear.vx, bear.vy) == (256, 384, -2, 0)
+
+    # Со следующего шага враг вне блоков и движется обычным образом
+    level.update_enemies(hero, view)
+
+    assert not bear.embedded
+
+    level.restore(level.snapshot())
+
+    assert bear.embedded
+
+
+def test_embedded_spawn_engine():
+    if main.enemy_engine is None:
+        return
+
+    level = main.Level("levels/world-2.json")
+    level.reset()
+    hero = main.Character(main.hero_images)
+    view = pygame.Rect(0, 0, main.WIDTH, main.HEIGHT)
+    engine = main.enemy_engine.EnemyEngine(level, 2 * main.WIDTH, 2 * main.GRID_SIZE)
+    engine.update(hero, view)
+    bear = embedded_bear(level)
+
+    assert (bear.rect.x, bear.rect.y, bear.vx, bear.vy) == (256, 384, -2, 0)
@@ -0,0 +1,55 @@
+import pygame
+
+import main
+
+# Уровень и персонаж создаются и сохраняются без окна (pygame.display не инициализирован)
+
+
+def test_no_display():
+    assert pygame.display.get_surface() is None
+
+
+def test_level_snapshot_without_display():
+    level = main.Level("levels/world-2.json")
+    level.reset()
+    state = level.snapshot()
+    hero = main.Character(main.hero_images)
+
+    for i in range(30):
+        level.update_enemies(hero, pygame.Rect(0, 0, main.WIDTH, main.HEIGHT))
+
+    assert level.snapshot() != state
+
+    level.restore(state)
+
+    assert level.snapshot() == state
+
+
+def test_character_snapshot_without_display():
+    level = main.Level("levels/world-1.json")
+    level.reset()
+    hero = main.Character(main.hero_images)
+    hero.respawn(level)
+    hero.move_right()
+
+    for i in range(30):
+        hero.update(level)
+
+    state = hero.snapshot()
+    other = main.Character(main.hero_images)
+    other.restore(state)
+
+    assert list(other.snapshot()) == list(state)
+    assert other.image is other.all_images()[other.frame]
+
+
+def test_enemy_engine_without_display():
+    if main.enemy_engine is None:
+        return
+
+    level = main.Level("levels/world-2.json")
+    level.reset()
+    engine = main.enemy_engine.EnemyEngine(level, 2 * main.WIDTH, 2 * main.GRID_SIZE)
+    engine.sync_all()
+
+    assert [int(f) for f in engine.frame] == [s.frame for s in engine.sprites]
@@ -0,0 +1,62 @@
+import math
+import struct
+import wave
+
+import pygame
+import pytest
+
+import main
+
+# Звуки загружаются и запускаются через SoundBank (микшер с аудиодрайвером "dummy", без окна)
+
+
+def write_tone(path, seconds=0.5, rate=22050):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(b"".join(struct.pack("<h", int(8000 * math.sin(i * 2 * math.pi * 440 / rate)))
+                               for i in range(int(seconds * rate))))
+
+
+@pytest.fixture
+def mixer():
+    pygame.mixer.init()
+    yield
+    pygame.mixer.quit()
+
+
+def test_sound_bank_plays_generated_sound(tmp_path, mixer):
+    path = str(tmp_path / "tone.wav")
+    write_tone(path)
+    bank = main.SoundBank(channels=1)
+    bank.preload({"tone": (path, 2), "quiet": (path, 1), "lost": (str(tmp_path / "lost.wav"), 3)})
+
+    assert set(bank.sounds) == {"tone", "quiet"}
+    assert bank.missing == {str(tmp_path / "lost.wav")}
+
+    channel = bank.play("tone")
+
+    assert channel is not None
+    assert channel.get_sound() is bank.sounds["tone"][0]
+
+    # Единственный канал занят звуком с большим приоритетом
+    assert bank.play("quiet") is None
+    assert bank.play("lost") is None
+
+
+def test_sound_bank_plays_generated_music(tmp_path, mixer):
+    path = str(tmp_path / "theme.wav")
+    write_tone(path)
+    bank = main.SoundBank()
+    bank.play_music(str(tmp_path / "lost.ogg"))
+
+    assert bank.music is None
+
+    bank.play_music(path)
+
+    assert bank.music == path
+
+    bank.stop_music()
+
+    assert bank.music is None
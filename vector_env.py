@@ -0,0 +1,235 @@
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Пакетный запуск многих независимых игр в нескольких процессах (без окна).
+# Интерфейс как у векторной среды: reset() и step(actions) возвращают массивы NumPy
+# для всех игр сразу. Наблюдения, награды и флаги окончания лежат в общей памяти:
+# процессы пишут их прямо в массивы, по каналам передаются только короткие команды.
+#
+#   env = VectorEnv(16)
+#   obs = env.reset()
+#   obs, rewards, dones = env.step(np.full(16, RIGHT_JUMP))
+#   env.close()
+
+# Действия: (влево, вправо, прыжок)
+NOOP, LEFT, RIGHT, JUMP, LEFT_JUMP, RIGHT_JUMP = range(6)
+ACTIONS = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 0, 1), (0, 1, 1)]
+
+# Наблюдение: состояние героя и блоки вокруг него (VIEW_COLS x VIEW_ROWS клеток, 1 - блок)
+HERO_STATE = ["x", "y", "vx", "vy", "on_ground", "hearts", "lives", "score"]
+VIEW_COLS = 9
+VIEW_ROWS = 7
+OBS_SIZE = len(HERO_STATE) + VIEW_COLS * VIEW_ROWS
+
+# Награда: за очки, за потерю сердца и за прохождение уровня
+SCORE_REWARD = 1.0
+HEART_PENALTY = -1.0
+COMPLETION_REWARD = 10.0
+
+# Эпизод заканчивается не позже чем через столько шагов
+MAX_EPISODE_STEPS = 60 * 60 * 5
+
+
+class Session():
+    # Одна игра внутри рабочего процесса
+
+    def __init__(self, main, level, max_steps):
+        self.main = main
+        self.level_index = level
+        self.max_steps = max_steps
+        self.game = main.Game(headless=True)
+
+    def reset(self):
+        game = self.game
+        game.hero = self.main.Character(self.main.hero_images)
+        game.current_level = self.level_index
+        game.start()
+        game.stage = self.main.Game.PLAYING
+        self.steps = 0
+
+    def step(self, action):
+        # Шаг игры; возвращает (награда, конец эпизода)
+        main, game, hero = self.main, self.game, self.game.hero
+        left, right, jump = ACTIONS[action]
+        score, hearts, lives = hero.score, hero.hearts, hero.lives
+
+        held = main.HeldKeys([key for key, on in ((main.LEFT, left), (main.RIGHT, right)) if on])
+        game.step(held, [main.JUMP] if jump else [])
+        self.steps += 1
+
+        reward = SCORE_REWARD * (hero.score - score)
+
+        # После потери всех сердец герой возрождается с полными сердцами, но теряет жизнь
+        if hero.lives < lives:
+            reward += HEART_PENALTY * hearts
+        elif hero.hearts < hearts:
+            reward += HEART_PENALTY * (hearts - hero.hearts)
+
+        if game.stage in (main.Game.LEVEL_COMPLETED, main.Game.VICTORY):
+            reward += COMPLETION_REWARD
+
+        done = game.stage != main.Game.PLAYING or self.steps >= self.max_steps
+
+        return reward, done
+
+    def observe(self, out):
+        # Запись наблюдения в строку out общего массива
+        hero = self.game.hero
+        out[:len(HERO_STATE)] = (hero.rect.x, hero.rect.y, hero.vx, hero.vy, hero.on_ground,
+                                 hero.hearts, hero.lives, hero.score)
+
+        tiles = self.game.level.tiles
+        cx = hero.rect.centerx // tiles.size - VIEW_COLS // 2
+        cy = hero.rect.centery // tiles.size - VIEW_ROWS // 2
+        view = out[len(HERO_STATE):].reshape(VIEW_ROWS, VIEW_COLS)
+        view[:] = 0
+
+        for y in range(max(cy, 0), min(cy + VIEW_ROWS, tiles.rows)):
+            for x in range(max(cx, 0), min(cx + VIEW_COLS, tiles.cols)):
+                view[y - cy, x - cx] = tiles.code_at(x, y) is not None
+
+
+def attach(memory, dtype, shape):
+    # Массив NumPy поверх блока общей памяти
+    return np.ndarray(shape, dtype, buffer=memory.buf)
+
+
+def worker(conn, memory, num_envs, envs, level, max_steps):
+    # Рабочий процесс: игры с номерами envs, массивы - в общей памяти
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    import main
+
+    obs = attach(memory["obs"], np.float32, (num_envs, OBS_SIZE))
+    rewards = attach(memory["rewards"], np.float32, (num_envs,))
+    dones = attach(memory["dones"], np.bool_, (num_envs,))
+    actions = attach(memory["actions"], np.int8, (num_envs,))
+
+    sessions = {i: Session(main, level, max_steps) for i in envs}
+
+    while True:
+        command = conn.recv()
+
+        if command == "reset":
+            for i, s in sessions.items():
+                s.reset()
+                s.observe(obs[i])
+                rewards[i] = 0
+                dones[i] = False
+
+        elif command == "step":
+            # Законченные эпизоды сразу начинаются заново (наблюдение - уже после сброса)
+            for i, s in sessions.items():
+                rewards[i], dones[i] = s.step(actions[i])
+
+                if dones[i]:
+                    s.reset()
+
+                s.observe(obs[i])
+
+        elif command == "close":
+            break
+
+        conn.send(command)
+
+    conn.close()
+
+
+class VectorEnv():
+    # num_envs игр в workers процессах (по умолчанию - по числу ядер)
+
+    def __init__(self, num_envs, workers=None, level=0, max_steps=MAX_EPISODE_STEPS):
+        self.num_envs = num_envs
+        workers = min(workers or os.cpu_count() or 1, num_envs)
+
+        shapes = {"obs": (np.float32, (num_envs, OBS_SIZE)),
+                  "rewards": (np.float32, (num_envs,)),
+                  "dones": (np.bool_, (num_envs,)),
+                  "actions": (np.int8, (num_envs,))}
+
+        self.memory = {name: shared_memory.SharedMemory(create=True, size=max(np.dtype(t).itemsize * int(np.prod(s)), 1))
+                       for name, (t, s) in shapes.items()}
+        self.arrays = {name: attach(self.memory[name], t, s) for name, (t, s) in shapes.items()}
+
+        # Игры делятся между процессами подряд идущими диапазонами
+        self.pipes = []
+        self.processes = []
+        bounds = np.linspace(0, num_envs, workers + 1).astype(int)
+
+        # Процессы запускаются заново, а не через fork: копировать состояние SDL
+        # из процесса, где pygame уже инициализирован, небезопасно
+        context = multiprocessing.get_context("spawn")
+
+        for w in range(workers):
+            parent, child = context.Pipe()
+            envs = range(bounds[w], bounds[w + 1])
+            p = context.Process(target=worker, args=(child, self.memory, num_envs, envs, level, max_steps),
+                                daemon=True)
+            p.start()
+            child.close()
+            self.pipes.append(parent)
+            self.processes.append(p)
+
+    def call(self, command):
+        # Команда всем процессам и ожидание, пока все ее выполнят
+        for pipe in self.pipes:
+            pipe.send(command)
+
+        for pipe in self.pipes:
+            pipe.recv()
+
+    def reset(self):
+        # Начало эпизода во всех играх; возвращает наблюдения (num_envs, OBS_SIZE)
+        self.call("reset")
+
+        return self.arrays["obs"]
+
+    def step(self, actions):
+        # Шаг всех игр; возвращает (наблюдения, награды, флаги окончания эпизода).
+        # Массивы общие и перезаписываются следующим шагом - копируйте, если нужно сохранить.
+        self.arrays["actions"][:] = actions
+        self.call("step")
+
+        return self.arrays["obs"], self.arrays["rewards"], self.arrays["dones"]
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send("close")
+
+        for p in self.processes:
+            p.join()
+
+        # Массивы должны быть освобождены до закрытия памяти
+        self.arrays.clear()
+
+        for m in self.memory.values():
+            m.close()
+            m.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def throughput(num_envs, workers=None, steps=600):
+    # Шагов игры в секунду (суммарно по всем играм)
+    with VectorEnv(num_envs, workers) as env:
+        env.reset()
+        actions = np.full(num_envs, RIGHT_JUMP, np.int8)
+        started = time.perf_counter()
+
+        for i in range(steps):
+            env.step(actions)
+
+        return num_envs * steps / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        print("%2d workers: %.0f steps/s" % (workers, throughput(4 * workers, workers)))